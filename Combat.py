@@ -0,0 +1,154 @@
+import random
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+# What a player can queue during a boss fight, and how a turn can end the fight.
+ATTACK, HEALTH_POTION, STAMINA_POTION, USE_BUFF, RETREAT = range(5)
+ONGOING, WON, LOST, RETREATED = range(4)
+
+# Damage is looked up by a roll out of DAMAGE_ROLLS, the highest roll is a critical hit.
+DAMAGE_ROLLS = 16
+MAX_TURN_ACTIONS = 3
+POTIONS = 2
+BUFF_TURNS = 3
+ATTACK_STAMINA = 15
+
+Stats = namedtuple('Stats', 'player_health player_stamina stamina_regen boss_health heal restore '
+                            'player_damage buffed_damage boss_damage')
+
+# player health, player stamina, boss health, turn, health potions, stamina potions, buffed turns left
+COMBAT_STATE = struct.Struct('<IHIIBBB')
+
+
+def damage_rolls(base: float):
+    """ Damage of every roll, spread from 75% to 125% of `base`, with the highest roll doubled. """
+    rolls = [max(1, round(base * (0.75 + 0.5 * roll / (DAMAGE_ROLLS - 2)))) for roll in range(DAMAGE_ROLLS - 1)]
+    return tuple(rolls + [rolls[-1] * 2])
+
+
+@lru_cache(maxsize=256)
+def stats(level: int):
+    """ Stats and damage tables of a boss fight at `level`, computed once and shared by every fight at that level. """
+    player_damage = 12 + 2 * level
+    return Stats(
+        player_health=100 + 10 * level,
+        player_stamina=60,
+        stamina_regen=5,
+        boss_health=80 + 30 * level,
+        heal=40 + 5 * level,
+        restore=45,
+        player_damage=damage_rolls(player_damage),
+        buffed_damage=damage_rolls(player_damage * 1.5),
+        boss_damage=damage_rolls(8 + 3 * level),
+    )
+
+
+Turn = namedtuple('Turn', 'outcome log buffs_used')
+
+
+class Combat:
+    """
+    A boss fight. Player actions are queued and resolved in one `resolve` call, each answered by the boss in a turn
+    of its own, so the queued actions are rendered and sent once however many there are. Every turn draws its rolls
+    from its own `random.Random`, seeded from the level seed and the turn number, so fights replay exactly from their
+    state.
+    """
+
+    def __init__(self, level: int, seed: int):
+        self.level = level
+        self.seed = seed
+        self.stats = stats(level)
+        self.player_health = self.stats.player_health
+        self.player_stamina = self.stats.player_stamina
+        self.boss_health = self.stats.boss_health
+        self.turn = 0
+        self.health_potions = POTIONS
+        self.stamina_potions = POTIONS
+        self.buff_turns = 0
+
+    def pack(self):
+        return COMBAT_STATE.pack(self.player_health, self.player_stamina, self.boss_health, self.turn,
+                                 self.health_potions, self.stamina_potions, self.buff_turns)
+
+    @classmethod
+    def unpack(cls, level: int, seed: int, data: bytes, offset: int = 0):
+        combat = cls(level, seed)
+        (combat.player_health, combat.player_stamina, combat.boss_health, combat.turn, combat.health_potions,
+         combat.stamina_potions, combat.buff_turns) = COMBAT_STATE.unpack_from(data, offset)
+        return combat
+
+    def status(self):
+        return (f"Boss ❤️ {self.boss_health:,}/{self.stats.boss_health:,} · You ❤️ {self.player_health:,}/"
+                f"{self.stats.player_health:,} ⚡ {self.player_stamina}/{self.stats.player_stamina} · "
+                f"potions {self.health_potions}❤️ {self.stamina_potions}⚡"
+                + (f" · buffed for {self.buff_turns} turns" if self.buff_turns else ""))
+
+    def resolve(self, actions, buffs: int = 0):
+        """
+        Plays the queued `actions` (at most MAX_TURN_ACTIONS of them), each as its own turn answered by the boss, so
+        actions queued together play out exactly as if they had been pressed one by one. `buffs` is how many collected
+        buffs the player can spend. Returns the outcome, the lines describing the turns and the buffs spent.
+        """
+        log, buffs_used = [], 0
+        for action in actions[:MAX_TURN_ACTIONS]:
+            outcome, used = self.exchange(action, buffs - buffs_used, log)
+            buffs_used += used
+            if outcome != ONGOING:
+                return Turn(outcome, log, buffs_used)
+        return Turn(ONGOING, log, buffs_used)
+
+    def exchange(self, action: int, buffs: int, log: list):
+        """ Plays one player action and the boss's reply, appending to `log`. Returns the outcome and buffs spent. """
+        rng = random.Random(self.seed + self.turn)
+        self.turn += 1
+        buffs_used = 0
+        if action == ATTACK:
+            if self.player_stamina < ATTACK_STAMINA:
+                log.append("You're too exhausted to attack.")
+            else:
+                self.player_stamina -= ATTACK_STAMINA
+                roll = rng.randrange(DAMAGE_ROLLS)
+                damage = (self.stats.buffed_damage if self.buff_turns else self.stats.player_damage)[roll]
+                self.boss_health = max(self.boss_health - damage, 0)
+                log.append(f"{'Critical hit! ' if roll == DAMAGE_ROLLS - 1 else ''}You hit the boss for {damage}.")
+                if not self.boss_health:
+                    log.append("The boss has been defeated!")
+                    return WON, buffs_used
+        elif action == HEALTH_POTION:
+            if not self.health_potions:
+                log.append("You're out of health potions.")
+            else:
+                self.health_potions -= 1
+                healed = min(self.stats.heal, self.stats.player_health - self.player_health)
+                self.player_health += healed
+                log.append(f"You drink a health potion and recover {healed} health.")
+        elif action == STAMINA_POTION:
+            if not self.stamina_potions:
+                log.append("You're out of stamina potions.")
+            else:
+                self.stamina_potions -= 1
+                self.player_stamina = min(self.player_stamina + self.stats.restore, self.stats.player_stamina)
+                log.append("You drink a stamina potion.")
+        elif action == USE_BUFF:
+            if not buffs:
+                log.append("You don't have any buffs left to use.")
+            else:
+                buffs_used = 1
+                self.buff_turns = BUFF_TURNS
+                log.append(f"You use a buff, your attacks are stronger for {BUFF_TURNS} turns.")
+        elif action == RETREAT:
+            log.append("You retreat from the boss.")
+            return RETREATED, buffs_used
+
+        roll = rng.randrange(DAMAGE_ROLLS)
+        damage = self.stats.boss_damage[roll]
+        self.player_health = max(self.player_health - damage, 0)
+        log.append(f"{'Critical hit! ' if roll == DAMAGE_ROLLS - 1 else ''}The boss hits you for {damage}.")
+        if not self.player_health:
+            log.append("You've been defeated by the boss.")
+            return LOST, buffs_used
+
+        self.buff_turns = max(self.buff_turns - 1, 0)
+        self.player_stamina = min(self.player_stamina + self.stats.stamina_regen, self.stats.player_stamina)
+        return ONGOING, buffs_used
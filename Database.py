@@ -1,27 +1,209 @@
+import asyncio
+import itertools
+import re
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-conn = sqlite3.connect('bot.db', timeout=5.0)
-c = conn.cursor()
+
+class SQLiteDatabase:
+    """
+    Async access to a sqlite database. Queries run on a small pool of worker threads that each keep
+    their own connection open, so the event loop never blocks on the database.
+    """
+
+    def __init__(self, path: str = 'bot.db', pool_size: int = 4, wal: bool = True, cached_statements: int = 256):
+        self.path = path
+        self.pool_size = pool_size
+        self.wal = wal
+        self.cached_statements = cached_statements
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def open_connection(self):
+        # sqlite3 keeps the last `cached_statements` prepared statements of each connection.
+        conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        if self.wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.open_connection()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _execute(self, statement, args):
+        conn = self.connection()
+        with conn:
+            conn.execute(statement, args)
+
+    def _executemany(self, statement, args_seq):
+        conn = self.connection()
+        with conn:
+            conn.executemany(statement, args_seq)
+
+    def _get(self, statement, args):
+        return self.connection().execute(statement, args).fetchall()
+
+    def _transaction(self, statements):
+        conn = self.connection()
+        with conn:
+            for statement, args in statements:
+                conn.execute(statement, args)
+
+    async def execute(self, statement, *args):
+        await self.run(self._execute, statement, args)
+
+    async def executemany(self, statement, args_seq):
+        """ Runs the statement once per parameter tuple, committed as a single transaction. """
+        await self.run(self._executemany, statement, list(args_seq))
+
+    async def get(self, statement, *args):
+        return await self.run(self._get, statement, args)
+
+    async def transaction(self, statements):
+        """ Runs a batch of (statement, args) pairs in one transaction, rolling all of them back on error. """
+        await self.run(self._transaction, list(statements))
+
+    def shutdown(self):
+        """ Waits for the running queries, then stops the worker threads and closes their connections. """
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+    async def close(self):
+        # Waiting for the worker threads would block the event loop, so it's done from another thread.
+        await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+
+
+# Quoted string literals and identifiers, which can contain a `?` that isn't a placeholder, or a lone placeholder.
+PLACEHOLDER_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\?")
+
+
+@lru_cache(maxsize=512)
+def to_postgres_placeholders(statement: str):
+    """ Converts sqlite style `?` placeholders into asyncpg's numbered `$1, $2, ...` placeholders. """
+    count = itertools.count(1)
+    return PLACEHOLDER_PATTERN.sub(lambda match: f'${next(count)}' if match.group() == '?' else match.group(),
+                                   statement)
+
+
+class PostgresDatabase:
+    """
+    Async access to a PostgreSQL database through an asyncpg connection pool. asyncpg prepares and caches
+    statements per connection, so repeated queries skip the parse step.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10, statement_cache_size: int = 256):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+
+    async def acquire_pool(self):
+        if self.pool is None:
+            # Callers arriving while the pool is being created wait for it instead of creating one of their own.
+            async with self.pool_lock:
+                if self.pool is None:
+                    import asyncpg
+
+                    self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size,
+                                                          statement_cache_size=self.statement_cache_size)
+        return self.pool
+
+    async def execute(self, statement, *args):
+        pool = await self.acquire_pool()
+        await pool.execute(to_postgres_placeholders(statement), *args)
+
+    async def executemany(self, statement, args_seq):
+        """ Runs the statement once per parameter tuple, committed as a single transaction. """
+        pool = await self.acquire_pool()
+        await pool.executemany(to_postgres_placeholders(statement), list(args_seq))
+
+    async def get(self, statement, *args):
+        pool = await self.acquire_pool()
+        return [tuple(record) for record in await pool.fetch(to_postgres_placeholders(statement), *args)]
+
+    async def transaction(self, statements):
+        """ Runs a batch of (statement, args) pairs in one transaction, rolling all of them back on error. """
+        pool = await self.acquire_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                for statement, args in statements:
+                    await conn.execute(to_postgres_placeholders(statement), *args)
+
+    def shutdown(self):
+        """ Closes the pool's connections right away, without waiting for the queries running on them. """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
 
 
 class Database:
+    """
+    `Database.pool` is the async database used by the bot. The static methods are a synchronous shim for
+    existing callers, they reuse one sqlite connection per thread instead of connecting on every call and only work
+    while `Database.pool` is a sqlite database.
+    """
+    pool = SQLiteDatabase('bot.db')
+    sync_local = threading.local()
+
+    @staticmethod
+    def configure(url: str = None):
+        """
+        Selects the async database, `postgres://...` urls use asyncpg and anything else is a sqlite path. Meant to be
+        called at startup, the previous database is shut down.
+        """
+        previous = Database.pool
+        if url and url.startswith(('postgres://', 'postgresql://')):
+            Database.pool = PostgresDatabase(url)
+        else:
+            Database.pool = SQLiteDatabase(url or 'bot.db')
+        previous.shutdown()
+        return Database.pool
+
     @staticmethod
     def connect():
-        conn = sqlite3.connect('bot.db')
-        c = conn.cursor()
-        return c
+        if not isinstance(Database.pool, SQLiteDatabase):
+            raise RuntimeError(f"The synchronous Database methods only support sqlite, not "
+                               f"{type(Database.pool).__name__}. Use the async Database.pool instead.")
+        path = Database.pool.path
+        conn = getattr(Database.sync_local, 'conn', None)
+        if conn is None or Database.sync_local.path != path:
+            if conn is not None:
+                conn.close()
+            conn = Database.sync_local.conn = sqlite3.connect(path, timeout=5.0)
+            Database.sync_local.path = path
+        return conn.cursor()
 
     @staticmethod
     def execute(statement, *args):
         c = Database.connect()
         c.execute(statement, args)
         c.connection.commit()
-        c.connection.close()
 
     @staticmethod
     def get(statement, *args):
         c = Database.connect()
         c.execute(statement, args)
-        res = c.fetchall()
-        c.connection.close()
-        return res
+        return c.fetchall()
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from Database import Database
+
+
+class TopK:
+    """ The `size` highest levels of one leaderboard, kept sorted as (-level, user_id) pairs. """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = []
+        self.levels = {}
+        self.ranks = {}
+        self.loaded_at = time.monotonic()
+
+    def update(self, user_id: int, level: int):
+        """ Returns True if the user entered the top or moved up in it. """
+        current = self.levels.get(user_id)
+        if current is not None:
+            if level <= current:
+                return False
+            del self.entries[bisect_left(self.entries, (-current, user_id))]
+        elif len(self.entries) >= self.size and (-level, user_id) >= self.entries[-1]:
+            return False
+
+        insort(self.entries, (-level, user_id))
+        self.levels[user_id] = level
+        if len(self.entries) > self.size:
+            _, dropped = self.entries.pop()
+            del self.levels[dropped]
+        return True
+
+    def rank(self, level: int):
+        # Competition ranking: one more than the number of players with a higher level.
+        return 1 + bisect_left(self.entries, (-level,))
+
+
+class Leaderboard:
+    """
+    Per guild and global leaderboards of the highest level players reached. Level ups are recorded in memory, update
+    the cached top `size` of their leaderboards right away and are written back in one transaction by `flush`.
+    Leaderboards are loaded from the indexed tables on first use, at most `max_cached` of them are kept. Ranks below
+    the top are looked up with an index range count and cached until the leaderboard changes. Level ups recorded by
+    other worker processes only reach the tables, so cached leaderboards are loaded again once `max_age` seconds old.
+    """
+
+    def __init__(self, size: int = 100, max_cached: int = 1000, max_age: float = 30.0):
+        self.size = size
+        self.max_cached = max_cached
+        self.max_age = max_age
+        self.tops = OrderedDict()
+        self.pending = {}
+        self.ready = False
+        self.flush_lock = asyncio.Lock()
+
+    async def setup(self):
+        if not self.ready:
+            await Database.pool.transaction([
+                ("CREATE TABLE IF NOT EXISTS guild_levels ("
+                 "guild_id BIGINT NOT NULL, user_id BIGINT NOT NULL, level INTEGER NOT NULL, "
+                 "PRIMARY KEY (guild_id, user_id))", ()),
+                ("CREATE INDEX IF NOT EXISTS guild_levels_by_level ON guild_levels (guild_id, level DESC)", ()),
+                ("CREATE TABLE IF NOT EXISTS player_levels ("
+                 "user_id BIGINT NOT NULL PRIMARY KEY, level INTEGER NOT NULL)", ()),
+                ("CREATE INDEX IF NOT EXISTS player_levels_by_level ON player_levels (level DESC)", ()),
+            ])
+            self.ready = True
+
+    @staticmethod
+    def query(guild_id: int = None):
+        """ Returns the table and the condition selecting one leaderboard, `guild_id` None is the global one. """
+        if guild_id is None:
+            return "player_levels", "1 = 1", ()
+        return "guild_levels", "guild_id = ?", (guild_id,)
+
+    def record(self, guild_id: int, user_id: int, level: int):
+        """ Records a level reached in a guild (0 outside of guilds), which also counts for the global leaderboard. """
+        self.pending[(guild_id, user_id)] = max(level, self.pending.get((guild_id, user_id), 0))
+        for scope in ((guild_id, None) if guild_id else (None,)):
+            top = self.tops.get(scope)
+            if top is not None:
+                top.update(user_id, level)
+                # Any level up can move other players down a rank.
+                top.ranks.clear()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            await self.setup()
+            pending, self.pending = self.pending, {}
+            statements = []
+            for (guild_id, user_id), level in pending.items():
+                if guild_id:
+                    statements.append((
+                        "INSERT INTO guild_levels (guild_id, user_id, level) VALUES (?, ?, ?) "
+                        "ON CONFLICT (guild_id, user_id) DO UPDATE SET level = excluded.level "
+                        "WHERE excluded.level > guild_levels.level", (guild_id, user_id, level)
+                    ))
+                statements.append((
+                    "INSERT INTO player_levels (user_id, level) VALUES (?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET level = excluded.level "
+                    "WHERE excluded.level > player_levels.level", (user_id, level)
+                ))
+            try:
+                await Database.pool.transaction(statements)
+            except Exception:
+                for key, level in pending.items():
+                    self.pending[key] = max(level, self.pending.get(key, 0))
+                raise
+
+    async def top(self, guild_id: int = None):
+        """ Returns the cached top of a leaderboard, loading it with one index scan if it isn't cached or too old. """
+        top = self.tops.get(guild_id)
+        if top is not None and time.monotonic() - top.loaded_at < self.max_age:
+            self.tops.move_to_end(guild_id)
+            return top
+
+        await self.setup()
+        await self.flush()
+        table, condition, args = self.query(guild_id)
+        rows = await Database.pool.get(
+            f"SELECT user_id, level FROM {table} WHERE {condition} ORDER BY level DESC, user_id LIMIT ?",
+            *args, self.size
+        )
+        cached = self.tops.get(guild_id)
+        if cached is not None and time.monotonic() - cached.loaded_at < self.max_age:
+            # Another call loaded it while the rows were loading.
+            return cached
+        top = self.tops[guild_id] = TopK(self.size)
+        self.tops.move_to_end(guild_id)
+        while len(self.tops) > self.max_cached:
+            self.tops.popitem(last=False)
+        for user_id, level in rows:
+            top.update(user_id, level)
+        # Level ups recorded while the rows were loading aren't in the table yet.
+        for (pending_guild_id, user_id), level in self.pending.items():
+            if guild_id is None or pending_guild_id == guild_id:
+                top.update(user_id, level)
+        return top
+
+    async def rank(self, guild_id: int, user_id: int):
+        """ Returns the (rank, level) of a player on a leaderboard, or None if they haven't reached a level yet. """
+        top = await self.top(guild_id)
+        if user_id in top.levels:
+            level = top.levels[user_id]
+            return top.rank(level), level
+        if user_id in top.ranks:
+            return top.ranks[user_id]
+
+        await self.flush()
+        table, condition, args = self.query(guild_id)
+        rows = await Database.pool.get(f"SELECT level FROM {table} WHERE {condition} AND user_id = ?", *args, user_id)
+        if not rows:
+            return None
+        level = rows[0][0]
+        higher = await Database.pool.get(f"SELECT COUNT(*) FROM {table} WHERE {condition} AND level > ?",
+                                         *args, level)
+        top.ranks[user_id] = (higher[0][0] + 1, level)
+        return top.ranks[user_id]
+
+    def invalidate(self, guild_id: int = None):
+        """ Drops a cached leaderboard, e.g. after editing its table by hand, so it is loaded again on next use. """
+        self.tops.pop(guild_id, None)
+
+
+leaderboard = Leaderboard()
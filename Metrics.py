@@ -0,0 +1,202 @@
+import functools
+import os
+import resource
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import asynccontextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket catches everything above.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def resident_memory():
+    """ Current resident memory of the process in bytes, or its peak where /proc isn't available. """
+    try:
+        with open("/proc/self/statm", "r") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """ Estimates a quantile as the upper bound of the bucket it falls in. """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def render_histogram(metric: str, histogram: Histogram, labels: str = ""):
+    """ The bucket, sum and count lines of a histogram in the Prometheus text format. """
+    prefix = f"{labels}," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f'{metric}_sum{suffix} {histogram.sum}')
+    lines.append(f'{metric}_count{suffix} {histogram.count}')
+    return lines
+
+
+class Span:
+    __slots__ = ('kind', 'name', 'start', 'rest', 'in_rest')
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.start = time.perf_counter()
+        self.rest = 0.0
+        self.in_rest = False
+
+
+class Metrics:
+    """
+    Latency histograms of commands and button presses. A recording starts with `begin` and ends with `finish`, both
+    keyed by the interaction's context. REST calls made inside `rest(ctx)`, which `time_rest` wraps around the
+    responding methods of the context classes, are counted as Discord round-trip time and everything else as our own
+    processing time. The event loop lag is kept apart in `loop_lag`.
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.histograms = {}
+        self.loop_lag = Histogram()
+        self.outcomes = Counter()
+        self.gateway_events = Counter()
+        self.started = time.monotonic()
+
+    def begin(self, kind: str, name: str, ctx):
+        self.spans[id(ctx)] = Span(kind, name)
+
+    def finish(self, ctx, status: str = 'ok'):
+        span = self.spans.pop(id(ctx), None)
+        if span is None:
+            return
+        total = time.perf_counter() - span.start
+        self.observe(span.kind, span.name, 'processing', total - span.rest)
+        self.observe(span.kind, span.name, 'rest', span.rest)
+        self.outcomes[(span.kind, span.name, status)] += 1
+
+    def observe(self, kind: str, name: str, phase: str, value: float):
+        key = (kind, name, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def observe_loop_lag(self, value: float):
+        self.loop_lag.observe(value)
+
+    @asynccontextmanager
+    async def rest(self, ctx):
+        span = self.spans.get(id(ctx))
+        if span is None or span.in_rest:
+            # A timed method calling another one is already inside the outer call's time.
+            yield
+            return
+        span.in_rest = True
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            span.rest += time.perf_counter() - started
+            span.in_rest = False
+
+    def time_rest(self, cls, *names):
+        """ Wraps the named coroutine methods of a context class, so every call is counted in `rest(ctx)`. """
+        for name in names:
+            method = cls.__dict__[name]
+            if not getattr(method, 'times_rest', False):
+                setattr(cls, name, self.timed_rest_call(method))
+
+    @staticmethod
+    def untime_rest(cls, *names):
+        for name in names:
+            method = cls.__dict__[name]
+            if getattr(method, 'times_rest', False):
+                setattr(cls, name, method.__wrapped__)
+
+    def timed_rest_call(self, method):
+        @functools.wraps(method)
+        async def wrapper(ctx, *args, **kwargs):
+            async with self.rest(ctx):
+                return await method(ctx, *args, **kwargs)
+
+        wrapper.times_rest = True
+        return wrapper
+
+    def timed_callback(self, callback):
+        """ Wraps a miru button callback `(self, button, ctx)` so every press is recorded under the callback's name. """
+        @functools.wraps(callback)
+        async def wrapper(view, button, ctx):
+            self.begin('button', callback.__name__, ctx)
+            status = 'error'
+            try:
+                await callback(view, button, ctx)
+                status = 'ok'
+            finally:
+                self.finish(ctx, status)
+
+        return wrapper
+
+    def summary(self):
+        """ Per command/button: count, processing p50/p99, REST p50/p99 and mean total latency in seconds. """
+        rows = []
+        for (kind, name, phase), histogram in sorted(self.histograms.items()):
+            if phase != 'processing':
+                continue
+            rest = self.histograms[(kind, name, 'rest')]
+            rows.append((kind, name, histogram.count, histogram.quantile(0.5), histogram.quantile(0.99),
+                         rest.quantile(0.5), rest.quantile(0.99), (histogram.sum + rest.sum) / histogram.count))
+        return rows
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP yuna_interaction_seconds Latency of commands and button presses, split into processing and REST.",
+            "# TYPE yuna_interaction_seconds histogram",
+        ]
+        for (kind, name, phase), histogram in sorted(self.histograms.items()):
+            labels = f'kind="{kind}",name="{name}",phase="{phase}"'
+            lines.extend(render_histogram("yuna_interaction_seconds", histogram, labels))
+
+        lines.append("# HELP yuna_event_loop_lag_seconds How late the event loop ran the lag monitor's heartbeat.")
+        lines.append("# TYPE yuna_event_loop_lag_seconds histogram")
+        lines.extend(render_histogram("yuna_event_loop_lag_seconds", self.loop_lag))
+
+        lines.append("# HELP yuna_interactions_total Finished commands and button presses by outcome.")
+        lines.append("# TYPE yuna_interactions_total counter")
+        for (kind, name, status), count in sorted(self.outcomes.items()):
+            lines.append(f'yuna_interactions_total{{kind="{kind}",name="{name}",status="{status}"}} {count}')
+
+        lines.append("# HELP yuna_gateway_events_total Gateway events received by the shards, by event name.")
+        lines.append("# TYPE yuna_gateway_events_total counter")
+        for event, count in sorted(self.gateway_events.items()):
+            lines.append(f'yuna_gateway_events_total{{event="{event}"}} {count}')
+        lines.append("# HELP yuna_resident_memory_bytes Resident memory of the process.")
+        lines.append("# TYPE yuna_resident_memory_bytes gauge")
+        lines.append(f"yuna_resident_memory_bytes {resident_memory()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
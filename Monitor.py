@@ -0,0 +1,96 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from Metrics import metrics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stall:
+    __slots__ = ('duration', 'handler', 'stack', 'at')
+
+    def __init__(self, duration: float, handler: str, stack: list):
+        self.duration = duration
+        self.handler = handler
+        self.stack = stack
+        self.at = time.time()
+
+
+class LagMonitor:
+    """
+    Measures how late the event loop runs a heartbeat scheduled every `interval` seconds. A watchdog thread samples
+    the loop thread's stack once the heartbeat is `threshold` seconds overdue, so stalls can be traced back to the
+    blocking handler without running the whole loop in asyncio debug mode. The last `keep` stalls are kept.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, keep: int = 100):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = deque(maxlen=keep)
+        self.heartbeat_task = None
+        self.stopped = None
+        self.loop_thread_id = None
+        self.last_beat = 0.0
+        self.sample = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.heartbeat_task = asyncio.get_running_loop().create_task(self.heartbeat())
+        self.stopped = threading.Event()
+        threading.Thread(target=self.watch, args=(self.stopped,), name="lag-monitor", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def heartbeat(self):
+        while self.running:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(now - expected, 0.0)
+            self.last_beat = now
+            metrics.observe_loop_lag(lag)
+
+            sample, self.sample = self.sample, None
+            if lag >= self.threshold:
+                handler, stack = sample or ("unknown", [])
+                self.stalls.append(Stall(lag, handler, stack))
+
+    def watch(self, stopped: threading.Event):
+        while not stopped.wait(self.threshold / 2):
+            if self.sample is None and time.perf_counter() - self.last_beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.sample = self.describe(frame)
+
+    @staticmethod
+    def describe(frame):
+        """ Returns the innermost frame belonging to this bot (or the innermost frame at all) and the stack. """
+        stack = traceback.extract_stack(frame)
+        handler = stack[-1]
+        for entry in reversed(stack):
+            if entry.filename.startswith(ROOT) and not entry.filename.endswith("Monitor.py"):
+                handler = entry
+                break
+        name = f"{os.path.relpath(handler.filename, ROOT)}:{handler.lineno} in {handler.name}"
+        return name, traceback.format_list(stack[-12:])
+
+    def worst(self, count: int = 10):
+        return sorted(self.stalls, key=lambda stall: stall.duration, reverse=True)[:count]
+
+
+lag_monitor = LagMonitor()
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import sys
+from collections import OrderedDict
+from Database import Database
+from Leaderboard import leaderboard
+
+log = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """
+    Write-behind persistence of game sessions. Sessions are only marked dirty when they change, and the
+    dirty ones are written in one batched transaction by `flush`, either on an interval or once
+    `flush_threshold` sessions are waiting.
+    """
+
+    def __init__(self, flush_threshold: int = 100):
+        self.flush_threshold = flush_threshold
+        self.dirty = {}
+        self.ready = False
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+
+    async def setup(self):
+        if not self.ready:
+            await Database.pool.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "guild_id BIGINT NOT NULL, user_id BIGINT NOT NULL, snapshot BYTEA NOT NULL, "
+                "PRIMARY KEY (guild_id, user_id))"
+            )
+            self.ready = True
+
+    def mark_dirty(self, key: tuple, session):
+        """ `key` is a (guild_id, user_id) pair and `session` anything with a `snapshot()` method returning bytes. """
+        self.dirty[key] = session
+        if len(self.dirty) >= self.flush_threshold and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            await self.setup()
+            pending, self.dirty = self.dirty, {}
+            rows = [(guild_id, user_id, session.snapshot()) for (guild_id, user_id), session in pending.items()]
+            try:
+                await Database.pool.executemany(
+                    "INSERT INTO sessions (guild_id, user_id, snapshot) VALUES (?, ?, ?) "
+                    "ON CONFLICT (guild_id, user_id) DO UPDATE SET snapshot = excluded.snapshot",
+                    rows,
+                )
+            except Exception:
+                # Keep the failed writes around for the next flush, unless they were marked dirty again meanwhile.
+                for key, session in pending.items():
+                    self.dirty.setdefault(key, session)
+                raise
+
+    async def load(self, key: tuple):
+        """ Returns the stored snapshot of a session, preferring one that has not been flushed yet. """
+        if key in self.dirty:
+            return self.dirty[key].snapshot()
+        await self.setup()
+        rows = await Database.pool.get("SELECT snapshot FROM sessions WHERE guild_id = ? AND user_id = ?", *key)
+        return bytes(rows[0][0]) if rows else None
+
+
+class MoveLog:
+    """
+    Event-sourced persistence of game sessions: a checkpoint snapshot followed by an append-only log of one byte move
+    codes. Moves are buffered per session and appended for all sessions in one transaction by `flush`. A checkpoint is
+    written on every level change (new levels come from a random pool, so replays never cross one) and every
+    `checkpoint_interval` moves, which bounds how many moves `load` has to hand back for replay.
+    """
+
+    def __init__(self, checkpoint_interval: int = 256, flush_threshold: int = 4096):
+        self.checkpoint_interval = checkpoint_interval
+        self.flush_threshold = flush_threshold
+        self.enabled = False
+        self.ready = False
+        self.sequences = {}
+        self.levels = {}
+        self.resets = set()
+        self.checkpoints = []
+        self.chunks = []
+        self.moves = {}
+        self.pending = 0
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+
+    async def setup(self):
+        if not self.ready:
+            await Database.pool.transaction([
+                ("CREATE TABLE IF NOT EXISTS move_log ("
+                 "guild_id BIGINT NOT NULL, user_id BIGINT NOT NULL, sequence BIGINT NOT NULL, moves BYTEA NOT NULL, "
+                 "PRIMARY KEY (guild_id, user_id, sequence))", ()),
+                ("CREATE TABLE IF NOT EXISTS move_checkpoints ("
+                 "guild_id BIGINT NOT NULL, user_id BIGINT NOT NULL, sequence BIGINT NOT NULL, "
+                 "snapshot BYTEA NOT NULL, PRIMARY KEY (guild_id, user_id, sequence))", ()),
+            ])
+            self.ready = True
+
+    def begin(self, key: tuple, session):
+        """ Starts a new log for the session, replacing its previous one, with `session` as the first checkpoint. """
+        self.resets.add(key)
+        self.discard(key)
+        self.sequences[key] = 0
+        self.levels[key] = session.level
+        self.checkpoints.append((key, 0, session.snapshot()))
+
+    def discard(self, key: tuple):
+        """ Drops the unflushed checkpoints and moves of a session. """
+        self.checkpoints = [entry for entry in self.checkpoints if entry[0] != key]
+        self.pending -= sum(len(moves) for entry_key, _, moves in self.chunks if entry_key == key)
+        self.chunks = [entry for entry in self.chunks if entry[0] != key]
+        self.pending -= len(self.moves.pop(key, (None, b''))[1])
+
+    def record(self, key: tuple, session, *moves: int):
+        """
+        Appends moves that have just been applied to `session`, which needs `level` and `snapshot()`. Moves recorded
+        together are never split by a checkpoint.
+        """
+        if key not in self.sequences:
+            self.begin(key, session)
+            return
+        start = self.sequences[key]
+        if key not in self.moves:
+            self.moves[key] = (start, bytearray())
+        self.moves[key][1].extend(moves)
+        self.sequences[key] = sequence = start + len(moves)
+        self.pending += len(moves)
+
+        interval = self.checkpoint_interval
+        if session.level != self.levels[key] or sequence // interval > start // interval:
+            # Moves after a checkpoint go into a new chunk, so a replay only has to read the chunks after it.
+            self.levels[key] = session.level
+            self.chunks.append((key, *self.moves.pop(key)))
+            self.checkpoints.append((key, sequence, session.snapshot()))
+        if self.pending >= self.flush_threshold and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not (self.resets or self.checkpoints or self.chunks or self.moves):
+                return
+            await self.setup()
+            chunks = self.chunks + [(key, sequence, moves) for key, (sequence, moves) in self.moves.items()]
+            statements = []
+            for guild_id, user_id in self.resets:
+                statements.append(("DELETE FROM move_log WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)))
+                statements.append(("DELETE FROM move_checkpoints WHERE guild_id = ? AND user_id = ?",
+                                   (guild_id, user_id)))
+            for (guild_id, user_id), sequence, snapshot in self.checkpoints:
+                statements.append(("INSERT INTO move_checkpoints (guild_id, user_id, sequence, snapshot) "
+                                   "VALUES (?, ?, ?, ?)", (guild_id, user_id, sequence, snapshot)))
+            for (guild_id, user_id), sequence, moves in chunks:
+                statements.append(("INSERT INTO move_log (guild_id, user_id, sequence, moves) VALUES (?, ?, ?, ?)",
+                                   (guild_id, user_id, sequence, bytes(moves))))
+
+            resets, checkpoints, self.resets, self.checkpoints = self.resets, self.checkpoints, set(), []
+            self.chunks, self.moves, self.pending = [], {}, 0
+            try:
+                await Database.pool.transaction(statements)
+            except Exception:
+                # Nothing of a failed flush was written, put it back in front of what was logged meanwhile,
+                # except for sessions that have started a new log since.
+                self.checkpoints = [entry for entry in checkpoints if entry[0] not in self.resets] + self.checkpoints
+                self.chunks = [entry for entry in chunks if entry[0] not in self.resets] + self.chunks
+                self.pending += sum(len(moves) for key, _, moves in chunks if key not in self.resets)
+                self.resets |= resets
+                raise
+
+    async def load(self, key: tuple, sequence: int = None):
+        """
+        Returns the checkpoint snapshot and the moves after it needed to rebuild the session as of `sequence` moves
+        (by default everything that was flushed), or None if the session has no log.
+        """
+        await self.flush()
+        await self.setup()
+        bound = sequence if sequence is not None else 2 ** 62
+        rows = await Database.pool.get(
+            "SELECT sequence, snapshot FROM move_checkpoints WHERE guild_id = ? AND user_id = ? AND sequence <= ? "
+            "ORDER BY sequence DESC LIMIT 1", *key, bound
+        )
+        if not rows:
+            return None
+        checkpoint, snapshot = rows[0]
+        chunks = await Database.pool.get(
+            "SELECT moves FROM move_log WHERE guild_id = ? AND user_id = ? AND sequence >= ? AND sequence < ? "
+            "ORDER BY sequence", *key, checkpoint, bound
+        )
+        moves = b''.join(bytes(moves) for moves, in chunks)
+        return bytes(snapshot), moves[:bound - checkpoint]
+
+    def stats(self):
+        return {"sessions": len(self.sequences), "pending_moves": self.pending,
+                "pending_checkpoints": len(self.checkpoints)}
+
+
+class SessionRegistry:
+    """
+    Tracks the live game views keyed by (guild_id, user_id), capped globally and per user. When a cap is hit the
+    least recently used session is evicted: its view is suspended and only a compact snapshot is kept, which
+    `take` hands back the next time the user starts a game.
+    """
+
+    def __init__(self, max_sessions: int = 1000, max_per_user: int = 2, max_snapshots: int = 5000):
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.max_snapshots = max_snapshots
+        self.live = OrderedDict()
+        self.user_sessions = {}
+        self.snapshots = OrderedDict()
+
+    def add(self, key: tuple, view):
+        """ `view` is expected to have a `field` with a `snapshot()` method, and a `suspend()` method. """
+        if key in self.live:
+            self.evict(key)
+        self.snapshots.pop(key, None)
+        self.live[key] = view
+        user_keys = self.user_sessions.setdefault(key[1], [])
+        user_keys.append(key)
+
+        while len(user_keys) > self.max_per_user:
+            self.evict(user_keys[0])
+        while len(self.live) > self.max_sessions:
+            self.evict(next(iter(self.live)))
+
+    def touch(self, key: tuple):
+        if key in self.live:
+            self.live.move_to_end(key)
+            # Each user's keys are kept in the same least recently used first order.
+            user_keys = self.user_sessions[key[1]]
+            user_keys.remove(key)
+            user_keys.append(key)
+
+    def evict(self, key: tuple, view=None):
+        """
+        Snapshots and suspends a live session. A view evicting itself (e.g. on timeout) passes itself as `view`,
+        the session is then only evicted if it still belongs to that view, which is left to stop on its own.
+        """
+        current = self.live.get(key)
+        if current is None or (view is not None and current is not view):
+            return
+        del self.live[key]
+        user_keys = self.user_sessions[key[1]]
+        user_keys.remove(key)
+        if not user_keys:
+            del self.user_sessions[key[1]]
+
+        self.snapshots[key] = current.field.snapshot()
+        # Evicted sessions are still persisted (by the move log when it's enabled, like every move of the view was),
+        # so the in-memory snapshots can be bounded.
+        if not move_log.enabled:
+            session_store.mark_dirty(key, current.field)
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        if view is None:
+            current.suspend()
+
+    def take(self, key: tuple):
+        """ Removes the session from the registry and returns its snapshot, or None if there is nothing to resume. """
+        if key in self.live:
+            self.evict(key)
+        return self.snapshots.pop(key, None)
+
+    def stats(self):
+        live_bytes = sum(view.field.memory_usage() for view in self.live.values())
+        snapshot_bytes = sum(sys.getsizeof(snapshot) for snapshot in self.snapshots.values())
+        return {
+            "live": len(self.live),
+            "users": len(self.user_sessions),
+            "snapshots": len(self.snapshots),
+            "live_bytes": live_bytes,
+            "snapshot_bytes": snapshot_bytes,
+        }
+
+
+session_store = SessionStore()
+move_log = MoveLog()
+session_registry = SessionRegistry()
+
+
+async def flush_all():
+    """
+    Writes out everything the write-behind stores are holding. A store that fails is logged and keeps its pending
+    writes for the next flush, and the other stores are still flushed.
+    """
+    for name, store in (("sessions", session_store), ("move log", move_log), ("leaderboard", leaderboard)):
+        try:
+            await store.flush()
+        except Exception:
+            log.exception("Flushing the %s failed, keeping its writes for the next flush.", name)
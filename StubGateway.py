@@ -0,0 +1,96 @@
+"""
+Lets Yuna run without Discord: `Yuna(..., stub_gateway=True)` starts on `StubShard`s instead of connecting its
+gateway shards, everything else (configuration, extensions, listeners, health reports) runs as it normally would.
+Used by `python Supervisor.py --stub` to exercise the supervisor and its workers locally.
+"""
+import asyncio
+import math
+import os
+import random
+import hikari
+
+
+class StubShard(hikari.api.GatewayShard):
+    """ Stands in for a gateway shard: "connects" after a short delay and reports a made up heartbeat latency. """
+
+    def __init__(self, shard_id: int, shard_count: int, intents: hikari.Intents, crash_after: float = None):
+        self._id = shard_id
+        self._shard_count = shard_count
+        self._intents = intents
+        self.crash_after = crash_after
+        self.alive = False
+        self.closed = asyncio.Event()
+
+    @property
+    def heartbeat_latency(self) -> float:
+        return random.uniform(0.02, 0.08) if self.alive else math.nan
+
+    @property
+    def id(self) -> int:
+        return self._id
+
+    @property
+    def intents(self) -> hikari.Intents:
+        return self._intents
+
+    @property
+    def is_alive(self) -> bool:
+        return self.alive
+
+    @property
+    def is_connected(self) -> bool:
+        return self.alive
+
+    @property
+    def shard_count(self) -> int:
+        return self._shard_count
+
+    def get_user_id(self) -> hikari.Snowflake:
+        return hikari.Snowflake(0)
+
+    async def start(self) -> None:
+        await asyncio.sleep(0.05)
+        self.alive = True
+        print(f"Shard {self._id}/{self._shard_count} connected to the stub gateway.")
+        if self.crash_after is not None:
+            asyncio.get_running_loop().call_later(self.crash_after, self.crash)
+
+    def crash(self):
+        print(f"Shard {self._id}/{self._shard_count} crashed the process on purpose.")
+        os._exit(1)
+
+    async def close(self) -> None:
+        self.alive = False
+        self.closed.set()
+
+    async def join(self) -> None:
+        await self.closed.wait()
+
+    async def update_presence(self, **kwargs) -> None:
+        pass
+
+    async def update_voice_state(self, guild, channel, **kwargs) -> None:
+        pass
+
+    async def request_guild_members(self, guild, **kwargs) -> None:
+        pass
+
+
+async def start_stub_gateway(bot: hikari.GatewayBot, shard_ids: list = None, shard_count: int = None,
+                             crash_after: float = None):
+    """
+    What `GatewayBot.start` does, minus asking Discord for the gateway and connecting: dispatches the starting and
+    started events around starting a `StubShard` per shard id, after which `bot.join()` and `bot.close()` work as usual.
+    """
+    shard_count = shard_count or 1
+    bot._closed_event = asyncio.Event()
+    bot._closing_event = asyncio.Event()
+    bot.rest.start()
+    bot.voice.start()
+
+    await bot.event_manager.dispatch(hikari.StartingEvent(app=bot))
+    for shard_id in shard_ids if shard_ids is not None else range(shard_count):
+        shard = StubShard(shard_id, shard_count, bot.intents, crash_after)
+        await shard.start()
+        bot._shards[shard_id] = shard
+    await bot.event_manager.dispatch(hikari.StartedEvent(app=bot))
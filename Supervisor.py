@@ -0,0 +1,232 @@
+"""
+Runs Yuna across several worker processes, each owning a contiguous range of gateway shards:
+
+    python Supervisor.py --workers 4 --shards 16
+
+Workers report their health and metrics to the supervisor through a pipe. The supervisor restarts workers that
+crash and serves the combined metrics of every worker on http://127.0.0.1:<port>/metrics. Game sessions already
+live in the database (see Session.py) and a guild always lands on the same shard, so workers share no memory.
+`--stub` runs the workers on the stub gateway of StubGateway.py instead of connecting to Discord, so the supervisor
+and its workers can be exercised locally.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import signal
+import time
+
+HEALTH_INTERVAL = 5.0
+
+
+def shard_ranges(workers: int, shards: int):
+    """ Splits shard ids 0..shards-1 into `workers` contiguous ranges that differ in size by at most one. """
+    return [list(range(shards * i // workers, shards * (i + 1) // workers)) for i in range(workers)]
+
+
+async def report_health(bot, conn, worker: int, shard_ids: list):
+    """ Runs inside a worker, periodically sends its health and metrics to the supervisor. """
+    from Metrics import metrics
+    from Session import session_registry
+
+    while True:
+        conn.send({
+            "worker": worker,
+            "pid": os.getpid(),
+            "shards": shard_ids,
+            "latency": bot.heartbeat_latency,
+            "guilds": len(bot.cache.get_guilds_view()),
+            "sessions": session_registry.stats()["live"],
+            "metrics": metrics.render_prometheus(),
+            "at": time.time(),
+        })
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+def run_worker(worker: int, shard_ids: list, shard_count: int, conn, stub: bool = False, crash_after: float = None):
+    import main
+
+    main.main(shard_ids=shard_ids, shard_count=shard_count, worker=worker, status=conn, stub=stub,
+              stub_crash_after=crash_after)
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: list):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.health = None
+        self.restarts = 0
+        self.failures = 0
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.stopped = False
+
+
+class Supervisor:
+    def __init__(self, workers: int, shards: int, stub: bool = False, crash_after: float = None,
+                 max_backoff: float = 60.0):
+        self.context = multiprocessing.get_context("spawn")
+        self.shard_count = shards
+        self.workers = [Worker(i, ids) for i, ids in enumerate(shard_ranges(workers, shards))]
+        self.stub = stub
+        self.crash_after = crash_after
+        self.max_backoff = max_backoff
+        self.closing = False
+
+    def spawn(self, worker: Worker):
+        parent, child = self.context.Pipe(duplex=False)
+        args = (worker.index, worker.shard_ids, self.shard_count, child, self.stub, self.crash_after)
+        worker.process = self.context.Process(target=run_worker, args=args, name=f"yuna-worker-{worker.index}")
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        child.close()
+        worker.conn = parent
+        print(f"Started worker {worker.index} (pid {worker.process.pid}) for shards "
+              f"{worker.shard_ids[0]}-{worker.shard_ids[-1]} of {self.shard_count}.")
+
+    def poll(self, worker: Worker):
+        try:
+            while worker.conn.poll():
+                worker.health = worker.conn.recv()
+        except (EOFError, OSError):
+            pass
+
+    def check(self, worker: Worker):
+        """ Restarts a crashed worker with exponential backoff, a worker that exited cleanly stays stopped. """
+        if worker.stopped or worker.process.is_alive():
+            return
+        if worker.restart_at == 0.0:
+            if worker.process.exitcode == 0:
+                print(f"Worker {worker.index} exited cleanly, not restarting it.")
+                worker.stopped = True
+                return
+            # A worker that stayed up for a while starts over with a short backoff.
+            if time.monotonic() - worker.started_at > self.max_backoff:
+                worker.failures = 0
+            backoff = min(2 ** worker.failures, self.max_backoff)
+            worker.failures += 1
+            worker.restart_at = time.monotonic() + backoff
+            print(f"Worker {worker.index} died with exit code {worker.process.exitcode}, restarting in {backoff:g}s.")
+        elif time.monotonic() >= worker.restart_at:
+            worker.restarts += 1
+            worker.restart_at = 0.0
+            worker.health = None
+            self.spawn(worker)
+
+    @staticmethod
+    def add_worker_label(sample: str, index: int):
+        name, separator, rest = re.match(r"(\w+)([{ ])(.*)", sample).groups()
+        if separator == "{":
+            return f'{name}{{worker="{index}",{rest}'
+        return f'{name}{{worker="{index}"}} {rest}'
+
+    def combined_metrics(self):
+        """ Merges the Prometheus text of every worker, adding a `worker` label to each sample. """
+        lines, seen = [], set()
+        for worker in self.workers:
+            if worker.health is None:
+                continue
+            for line in worker.health["metrics"].splitlines():
+                if line.startswith("#"):
+                    if line not in seen:
+                        seen.add(line)
+                        lines.append(line)
+                else:
+                    lines.append(self.add_worker_label(line, worker.index))
+
+        lines.append("# TYPE yuna_worker_up gauge")
+        lines.append("# TYPE yuna_worker_restarts_total counter")
+        lines.append("# TYPE yuna_worker_heartbeat_latency_seconds gauge")
+        for worker in self.workers:
+            up = int(worker.process is not None and worker.process.is_alive())
+            lines.append(f'yuna_worker_up{{worker="{worker.index}"}} {up}')
+            lines.append(f'yuna_worker_restarts_total{{worker="{worker.index}"}} {worker.restarts}')
+            if worker.health is not None:
+                lines.append(f'yuna_worker_heartbeat_latency_seconds{{worker="{worker.index}"}} '
+                             f'{worker.health["latency"]}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        rows = []
+        for worker in self.workers:
+            health = worker.health or {}
+            state = "up" if worker.process.is_alive() else ("stopped" if worker.stopped else "down")
+            latency = health.get("latency")
+            rows.append(f"worker {worker.index} [{state}] shards {worker.shard_ids[0]}-{worker.shard_ids[-1]} "
+                        f"guilds {health.get('guilds', '?')} sessions {health.get('sessions', '?')} "
+                        f"latency {f'{latency * 1000:.0f}ms' if latency is not None else '?'} "
+                        f"restarts {worker.restarts}")
+        return "\n".join(rows)
+
+    async def serve(self, port: int):
+        from aiohttp import web
+
+        async def metrics_handler(request):
+            return web.Response(text=self.combined_metrics(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+    async def run(self, port: int = None, summary_interval: float = 30.0):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.close)
+
+        for worker in self.workers:
+            self.spawn(worker)
+        runner = await self.serve(port) if port else None
+
+        last_summary = time.monotonic()
+        try:
+            while not self.closing and not all(worker.stopped for worker in self.workers):
+                for worker in self.workers:
+                    self.poll(worker)
+                    self.check(worker)
+                if time.monotonic() - last_summary >= summary_interval:
+                    print(self.summary())
+                    last_summary = time.monotonic()
+                await asyncio.sleep(0.5)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            self.shutdown()
+
+    def close(self):
+        self.closing = True
+
+    def shutdown(self, timeout: float = 30.0):
+        """ Asks every worker to stop (hikari closes gracefully on SIGTERM) and kills the ones that don't. """
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(max(deadline - time.monotonic(), 0))
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Runs Yuna sharded across several worker processes.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--shards", type=int, help="total number of shards, defaults to one per worker")
+    parser.add_argument("--port", type=int, default=9100, help="port of the combined metrics endpoint, 0 to disable")
+    parser.add_argument("--stub", action="store_true", help="use a stub gateway instead of connecting to Discord")
+    parser.add_argument("--stub-crash-after", type=float,
+                        help="make the stub shards crash their worker after this many seconds")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    supervisor = Supervisor(arguments.workers, arguments.shards or arguments.workers, stub=arguments.stub,
+                            crash_after=arguments.stub_crash_after)
+    asyncio.run(supervisor.run(port=arguments.port or None))
@@ -0,0 +1,225 @@
+"""
+Headless benchmark of the field game. Drives `Field` and `View` through their real button callbacks with a fake
+miru context and a stub REST client, so it runs offline. Run it from the repository root:
+
+    python -m benchmarks.field_benchmark --sessions 50 --moves 2000 --output bench.json
+
+Results are written as JSON so runs of different versions can be compared.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import hikari
+import miru
+
+from Database import Database
+
+MOVE_BUTTONS = ("up_button", "down_button", "left_button", "right_button")
+# Pressed instead of the move buttons while a session is in a boss fight, attacking most of the time.
+FIGHT_BUTTONS = ("middle_attack_button",) * 6 + ("top_left_health_potion_button", "top_right_stamina_potion_button",
+                                                 "bottom_right_buff_button", "bottom_left_retreat_button")
+
+
+class StubREST:
+    """ Stands in for Discord, every call just sleeps for `latency` seconds and is counted. """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def request(self, route: str):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class StubApp:
+    """ Has the attributes miru checks for in `miru.load`, nothing else is used headlessly. """
+
+    def __init__(self, rest: StubREST):
+        self.rest = rest
+        self.event_manager = None
+        self.entity_factory = None
+        self.executor = None
+        self.http_settings = None
+        self.proxy_settings = None
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.display_avatar_url = f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png"
+
+    def __str__(self):
+        return f"player{self.id}"
+
+
+class FakeLightbulbContext:
+    def __init__(self, user: FakeUser):
+        self.guild_id = 1
+        self.author = user
+
+
+class FakeContext:
+    """ The parts of `miru.Context` used by the field View, responses go to the stub REST client. """
+
+    def __init__(self, rest: StubREST, user: FakeUser):
+        self.rest = rest
+        self.user = user
+
+    async def defer(self, flags=None):
+        await self.rest.request("defer")
+
+    async def edit_response(self, content=hikari.UNDEFINED, **kwargs):
+        await self.rest.request("edit_response")
+
+
+def pick_button(view, rng: random.Random):
+    return getattr(view, rng.choice(FIGHT_BUTTONS if view.field.boss_fight_state else MOVE_BUTTONS))
+
+
+def percentile(samples: list, pct: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_session(view, rest: StubREST, user: FakeUser, moves: int, rng: random.Random, interval: float,
+                      latencies: list):
+    for _ in range(moves):
+        button = pick_button(view, rng)
+        ctx = FakeContext(rest, user)
+        started = time.perf_counter()
+        await button.callback(ctx)
+        latencies.append(time.perf_counter() - started)
+        if interval:
+            await asyncio.sleep(interval)
+    if view.edit_task is not None:
+        await view.edit_task
+
+
+async def create_view(rest: StubREST, user: FakeUser, coalesce: bool):
+    from components.field_handler import Field, View
+
+    field = Field(12, 12, 15, 3)
+    await field.generate_field()
+    return View(FakeLightbulbContext(user), field, coalesce=coalesce)
+
+
+async def measure_latency(args):
+    rest = StubREST(args.rest_latency)
+    users = [FakeUser(i) for i in range(args.sessions)]
+    views = [await create_view(rest, user, not args.no_coalesce) for user in users]
+    latencies = []
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_session(view, rest, user, args.moves, random.Random(args.seed + i), args.interval, latencies)
+        for i, (view, user) in enumerate(zip(views, users))
+    ))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "interactions": len(latencies),
+        "wall_seconds": elapsed,
+        "interactions_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "rest_calls": dict(rest.calls),
+        "edits_per_move": rest.calls["edit_response"] / len(latencies),
+        "dropped_actions": sum(view.dropped_actions for view in views),
+    }
+
+
+async def measure_allocations(args):
+    """ Runs one session without REST latency under tracemalloc and reports the memory churn of a single move. """
+    rest = StubREST(0)
+    user = FakeUser(0)
+    view = await create_view(rest, user, coalesce=False)
+    rng = random.Random(args.seed)
+    transient, retained, blocks = [], [], []
+
+    gc.collect()
+    tracemalloc.start()
+    for _ in range(args.allocation_moves):
+        button = pick_button(view, rng)
+        before, _ = tracemalloc.get_traced_memory()
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        await button.callback(FakeContext(rest, user))
+        after, peak = tracemalloc.get_traced_memory()
+        transient.append(peak - before)
+        retained.append(after - before)
+        blocks.append(sys.getallocatedblocks() - blocks_before)
+    tracemalloc.stop()
+
+    return {
+        "moves": len(transient),
+        "peak_bytes_per_move": {"p50": percentile(transient, 50), "p99": percentile(transient, 99)},
+        "retained_bytes_per_move": sum(retained) / len(retained),
+        "retained_blocks_per_move": sum(blocks) / len(blocks),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        Database.configure(f"{directory}/benchmark.db")
+        miru.load(StubApp(StubREST(0)))
+
+        result = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "parameters": vars(args),
+            "latency": await measure_latency(args),
+            "allocations": await measure_allocations(args),
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        await Database.pool.close()
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless latency and memory benchmark of the field game.")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent game sessions")
+    parser.add_argument("--moves", type=int, default=1000, help="scripted moves per session")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between two moves of a session")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="simulated Discord REST latency in seconds")
+    parser.add_argument("--no-coalesce", action="store_true", help="edit the message on every press")
+    parser.add_argument("--allocation-moves", type=int, default=2000, help="moves measured under tracemalloc")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the scripted moves")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results = json.dumps(asyncio.run(main(arguments)), indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf8") as stream:
+            stream.write(results + "\n")
+    else:
+        print(results)
@@ -0,0 +1,283 @@
+"""
+Offline simulator of the field game for tuning field sizes and buff counts. Levels are generated and played by agents
+in batches of NumPy arrays, one array operation per move for the whole batch, following the rules of `Field`:
+
+- the player starts at (1, 1) and the exit (where the boss stands) is the top right cell,
+- moves out of the map or into the two barriers below the exit are reverted,
+- a buff is picked up by moving onto it and the level ends on reaching the exit, where the boss fight starts.
+
+Agents are "random" (uniform moves), "rush" (shortest path to the exit) and "greedy" (shortest path to the nearest
+buff until none are left, then to the exit). Sampled games are replayed through the real `Field` afterwards to check
+that the simulator still follows its rules. Run it from the repository root:
+
+    python -m benchmarks.level_simulator --games 200000 --size 12 12 --buffs 5 15 30 --output simulation.csv
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+import pandas as pd
+
+# (delta_x, delta_y) of the move codes MOVE_UP, MOVE_RIGHT, MOVE_DOWN and MOVE_LEFT of the field handler.
+DELTAS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)])
+UNREACHABLE = np.iinfo(np.int16).max
+
+
+class Board:
+    """
+    The static part of a field of one size. Cells are numbered (y - 1) * size_x + x - 1, `moves[cell, code]` is the
+    cell a move ends on (the same cell if the move is reverted) and `exit_distances` holds the shortest path length
+    from every cell to the exit, which the agents walk along.
+    """
+
+    def __init__(self, size_x: int, size_y: int):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.cells = size_x * size_y
+        self.x = np.tile(np.arange(1, size_x + 1), size_y)
+        self.y = np.repeat(np.arange(1, size_y + 1), size_x)
+        self.start = self.cell(1, 1)
+        self.exit = self.cell(size_x, size_y)
+
+        self.barrier = np.zeros(self.cells, dtype=bool)
+        self.barrier[[self.cell(size_x, size_y - 1), self.cell(size_x - 1, size_y - 1)]] = True
+
+        next_x = self.x[:, None] + DELTAS[:, 0]
+        next_y = self.y[:, None] + DELTAS[:, 1]
+        inside = (next_x >= 1) & (next_x <= size_x) & (next_y >= 1) & (next_y <= size_y)
+        target = np.where(inside, (next_y - 1) * size_x + next_x - 1, 0)
+        allowed = inside & ~self.barrier[target]
+        self.moves = np.where(allowed, target, np.arange(self.cells)[:, None])
+
+        # Buffs go anywhere in 1..size - 1 on both axes, except the start, the boss and the barriers.
+        free = (self.x < size_x) & (self.y < size_y) & ~self.barrier
+        free[[self.start, self.exit]] = False
+        self.free_cells = np.flatnonzero(free)
+
+        exit_mask = np.zeros((1, self.cells), dtype=bool)
+        exit_mask[0, self.exit] = True
+        self.exit_distances = self.distances_to(exit_mask, np.arange(self.cells)[None])[0]
+
+    def cell(self, x: int, y: int):
+        return (y - 1) * self.size_x + x - 1
+
+    def distances_to(self, targets, cells):
+        """
+        Breadth-first search outwards from the `targets` of every game (a cell mask per row), one frontier expansion
+        per step for the whole batch. Returns the distances of `cells` (cell numbers per row) to their nearest target
+        and stops as soon as all of them are reached, so a step towards a nearby target only searches its surroundings.
+        Moves between free cells go both ways, so searching from the targets gives the paths towards them.
+        """
+        # The search runs on (cell, game) bit arrays, eight games to a byte, so following a move gathers whole rows.
+        games = np.arange(len(targets))[:, None]
+        width = -(-len(targets) // 8)
+        padded = np.zeros((width * 8, self.cells), dtype=np.uint8)
+        padded[:len(targets)] = targets
+        bits = np.arange(8, dtype=np.uint8)[:, None]
+        packed = (padded.reshape(width, 8, self.cells) << bits).sum(axis=1, dtype=np.uint8)
+        free = np.where(self.barrier, 0, 0xFF).astype(np.uint8)[:, None]
+        reached = np.ascontiguousarray(packed.T) & free
+        frontier = reached.copy()
+        # The byte and bit of every game's `cells` in the flattened bit arrays.
+        index, shift = cells * width + games // 8, (games % 8).astype(np.uint8)
+        distances = np.where((np.take(reached, index) >> shift) & 1, 0, UNREACHABLE).astype(np.int16)
+        step = 0
+        while frontier.any() and (distances == UNREACHABLE).any():
+            step += 1
+            expanded = frontier[self.moves[:, 0]]
+            for code in range(1, len(DELTAS)):
+                expanded |= frontier[self.moves[:, code]]
+            frontier = expanded & free & ~reached
+            reached |= frontier
+            distances[((np.take(frontier, index) >> shift) & 1).astype(bool)] = step
+        return distances
+
+
+def generate_buffs(rng: np.random.Generator, board: Board, games: int, buff_tile: int):
+    """ Places `buff_tile` buffs on distinct free cells of every game, uniformly like `random.sample` in `Field`. """
+    if buff_tile > len(board.free_cells):
+        raise ValueError(f"Cannot place {buff_tile} buff tiles on a field with {len(board.free_cells)} free cells.")
+    buffs = np.zeros((games, board.cells), dtype=bool)
+    if buff_tile:
+        picks = np.argpartition(rng.random((games, len(board.free_cells))), buff_tile - 1, axis=1)[:, :buff_tile]
+        buffs[np.arange(games)[:, None], board.free_cells[picks]] = True
+    return buffs
+
+
+def random_agent(rng, board, position, buffs):
+    return rng.integers(0, 4, len(position))
+
+
+def walk_towards(remaining):
+    """
+    Move codes of a first step along a shortest path, given the distance left to the target after each move,
+    preferring up, right, down and left in that order.
+    """
+    return np.argmin(remaining, axis=1)
+
+
+def rush_agent(rng, board, position, buffs):
+    return walk_towards(board.exit_distances[board.moves[position]])
+
+
+def greedy_agent(rng, board, position, buffs):
+    codes = rush_agent(rng, board, position, buffs)
+    hunting = buffs.any(axis=1)
+    if hunting.any():
+        codes[hunting] = walk_towards(board.distances_to(buffs[hunting], board.moves[position[hunting]]))
+    return codes
+
+
+AGENTS = {"random": random_agent, "rush": rush_agent, "greedy": greedy_agent}
+
+
+def simulate(rng: np.random.Generator, board: Board, buffs, agent: str, max_moves: int, traced: int = 0):
+    """
+    Plays one level of every game in the batch, `buffs` is updated in place. Returns the per game results and the
+    moves, positions and remaining buffs after every move of the first `traced` games.
+    """
+    games = len(buffs)
+    position = np.full(games, board.start)
+    active = np.ones(games, dtype=bool)
+    moves = np.zeros(games, dtype=np.int32)
+    blocked = np.zeros(games, dtype=np.int32)
+    collected = np.zeros(games, dtype=np.int32)
+    trace = np.full((traced, max_moves, 3), -1, dtype=np.int32)
+
+    for step in range(max_moves):
+        playing = np.flatnonzero(active)
+        if not playing.size:
+            break
+        codes = AGENTS[agent](rng, board, position[playing], buffs[playing])
+        before = position[playing]
+        after = board.moves[before, codes]
+        blocked[playing] += after == before
+        moves[playing] += 1
+        position[playing] = after
+
+        exited = after == board.exit
+        active[playing[exited]] = False
+        picked = ~exited & buffs[playing, after]
+        buffs[playing[picked], after[picked]] = False
+        collected[playing[picked]] += 1
+
+        traced_games = playing[playing < traced]
+        trace[traced_games, step, 0] = codes[:len(traced_games)]
+        trace[traced_games, step, 1] = position[traced_games]
+        trace[traced_games, step, 2] = buffs[traced_games].sum(axis=1)
+
+    results = {
+        "moves": moves,
+        "blocked_moves": blocked,
+        "buffs_collected": collected,
+        "reached_exit": ~active,
+    }
+    return results, trace
+
+
+async def verify(board: Board, buff_tile: int, initial_buffs, trace):
+    """
+    Replays traced games through the real `Field` and returns how many of them played out differently. The buffs of
+    the replays are taken over from the simulation, so the cells they can go on are checked against `Field` first.
+    """
+    from components.field_handler import Field, free_cells
+
+    field = Field(board.size_x, board.size_y, buff_tile, 1, seed=0)
+    expected = [board.cell(x, y) for x, y in free_cells(board.size_x, board.size_y, field.blocked_cells())]
+    if sorted(expected) != board.free_cells.tolist():
+        raise AssertionError(f"Board places buffs on other cells than Field does on a {board.size_x}x{board.size_y} "
+                             f"field, the simulator is out of date.")
+
+    mismatches = 0
+    for game, moves in enumerate(trace):
+        field = Field(board.size_x, board.size_y, buff_tile, 1, seed=0)
+        field.buff_coordinates = {(int(board.x[cell]), int(board.y[cell]))
+                                  for cell in np.flatnonzero(initial_buffs[game])}
+        await field.generate_field()
+        for code, position, remaining in moves:
+            if code < 0:
+                break
+            await field.play(int(code))
+            if position == board.exit:
+                expected = field.boss_fight_state and len(field.buff_coordinates) == remaining
+            else:
+                expected = ((field.start_x, field.start_y) == (board.x[position], board.y[position])
+                            and len(field.buff_coordinates) == remaining)
+            if not expected:
+                mismatches += 1
+                break
+    return mismatches
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    frames, verified, mismatches = [], 0, 0
+    for size_x, size_y in args.size:
+        board = Board(size_x, size_y)
+        for buff_tile in args.buffs:
+            for agent in args.agent:
+                started = time.perf_counter()
+                for offset in range(0, args.games, args.batch_size):
+                    games = min(args.batch_size, args.games - offset)
+                    buffs = generate_buffs(rng, board, games, buff_tile)
+                    traced = min(args.verify, games) if offset == 0 else 0
+                    initial_buffs = buffs[:traced].copy()
+                    results, trace = simulate(rng, board, buffs, agent, args.max_moves, traced)
+                    if traced:
+                        mismatches += asyncio.run(verify(board, buff_tile, initial_buffs, trace))
+                        verified += traced
+                    frames.append(pd.DataFrame({
+                        "game": np.arange(offset, offset + games),
+                        "size_x": size_x,
+                        "size_y": size_y,
+                        "buff_tile": buff_tile,
+                        "agent": agent,
+                        **results,
+                    }))
+                print(f"{size_x}x{size_y}, {buff_tile} buffs, {agent}: {args.games:,} games in "
+                      f"{time.perf_counter() - started:.2f}s")
+
+    frame = pd.concat(frames, ignore_index=True)
+    print(f"Replayed {verified:,} games through Field, {mismatches:,} played out differently.")
+    return frame, mismatches
+
+
+def summarise(frame):
+    return frame.groupby(["size_x", "size_y", "buff_tile", "agent"]).agg(
+        games=("game", "size"),
+        moves_mean=("moves", "mean"),
+        moves_p90=("moves", lambda moves: moves.quantile(0.9)),
+        blocked_mean=("blocked_moves", "mean"),
+        buffs_mean=("buffs_collected", "mean"),
+        exit_rate=("reached_exit", "mean"),
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch simulator of field levels for balance testing.")
+    parser.add_argument("--games", type=int, default=100000, help="levels played per configuration")
+    parser.add_argument("--size", type=int, nargs=2, action="append", metavar=("X", "Y"),
+                        help="field size, can be given more than once (default 12 12)")
+    parser.add_argument("--buffs", type=int, nargs="+", default=[15], help="buff tiles per level")
+    parser.add_argument("--agent", nargs="+", choices=tuple(AGENTS), default=list(AGENTS), help="agents to play with")
+    parser.add_argument("--max-moves", type=int, default=2000, help="moves after which a level is given up")
+    parser.add_argument("--batch-size", type=int, default=20000, help="games simulated at once")
+    parser.add_argument("--verify", type=int, default=200, help="games per configuration replayed through Field")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the layouts and the random agent")
+    parser.add_argument("--output", help="write the per game results to this .csv or .parquet file")
+    args = parser.parse_args(argv)
+    args.size = args.size or [(12, 12)]
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results, differences = run(arguments)
+    print(summarise(results).to_string())
+    if arguments.output:
+        if arguments.output.endswith(".parquet"):
+            results.to_parquet(arguments.output)
+        else:
+            results.to_csv(arguments.output, index=False)
+    raise SystemExit(1 if differences else 0)
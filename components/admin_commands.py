@@ -1,5 +1,9 @@
 import hikari
 import lightbulb
+import time
+from Metrics import metrics, resident_memory
+from Monitor import lag_monitor
+from Session import session_store, session_registry, move_log, flush_all
 
 plugin = lightbulb.Plugin("Admin Commands")
 plugin.add_checks(lightbulb.checks.owner_only)
@@ -10,6 +14,7 @@ plugin.add_checks(lightbulb.checks.owner_only)
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
 async def kill_command(ctx: lightbulb.Context):
     await ctx.respond("Successfully killed the bot.")
+    await flush_all()
     await plugin.bot.close()
 
 
@@ -20,14 +25,102 @@ async def ping_command(ctx: lightbulb.Context):
     await ctx.respond("Pong!")
 
 
+@plugin.command
+@lightbulb.command("sessions", "Shows the live game sessions and their memory usage.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def sessions_command(ctx: lightbulb.Context):
+    stats = session_registry.stats()
+    description = (f"Live sessions: **{stats['live']:,}** ({stats['users']:,} users, {stats['live_bytes']:,} bytes)\n"
+                   f"Evicted snapshots: **{stats['snapshots']:,}** ({stats['snapshot_bytes']:,} bytes)\n"
+                   f"Pending writes: **{len(session_store.dirty):,}**")
+    if move_log.enabled:
+        log = move_log.stats()
+        description += (f"\nLogged sessions: **{log['sessions']:,}** ({log['pending_moves']:,} moves and "
+                        f"{log['pending_checkpoints']:,} checkpoints pending)")
+    await ctx.respond(embed=hikari.Embed(title="Sessions", description=description))
+
+
+@plugin.command
+@lightbulb.option("sequence", "Number of moves to replay, defaults to all of them.", int, required=False)
+@lightbulb.option("user", "Player whose game is replayed.", hikari.User)
+@lightbulb.command("replay", "Rebuilds a game of this server from its move log.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def replay_command(ctx: lightbulb.Context):
+    # Imported here so this plugin doesn't hold on to an old field_handler module across reloads.
+    from components.field_handler import Field
+
+    entry = await move_log.load((ctx.guild_id or 0, ctx.options.user.id), ctx.options.sequence)
+    if entry is None:
+        await ctx.respond(f"There's no move log of {ctx.options.user}.")
+        return
+    snapshot, moves = entry
+    field = await Field.replay(snapshot, moves)
+    await field.generate_field()
+    embed = hikari.Embed(title=f"Replay of {ctx.options.user}", description=field.field_text)
+    embed.set_footer(text=f"Level {field.level}, at ({field.start_x}, {field.start_y}), "
+                          f"{len(moves):,} moves after the checkpoint")
+    await ctx.respond(embed=embed)
+
+
+@plugin.command
+@lightbulb.command("metrics", "Shows the latency of commands and buttons.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def metrics_command(ctx: lightbulb.Context):
+    lines = [f"`{kind}:{name}` ×{count:,} — processing p50 ≤{p50 * 1000:g}ms p99 ≤{p99 * 1000:g}ms, "
+             f"REST p50 ≤{rest_p50 * 1000:g}ms p99 ≤{rest_p99 * 1000:g}ms, mean {mean * 1000:.1f}ms"
+             for kind, name, count, p50, p99, rest_p50, rest_p99, mean in metrics.summary()]
+    await ctx.respond(embed=hikari.Embed(title="Latency", description="\n".join(lines) or "Nothing recorded yet."))
+
+
+@plugin.command
+@lightbulb.command("profile", "Shows the gateway intents, cache, memory and gateway event volume of the bot.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def profile_command(ctx: lightbulb.Context):
+    profile, intents, cache_components = plugin.bot.d.profile or ("unknown", plugin.bot.intents, None)
+    cache = plugin.bot.cache
+    cached = {
+        "guilds": len(cache.get_guilds_view()),
+        "members": sum(len(members) for members in cache.get_members_view().values()),
+        "presences": sum(len(presences) for presences in cache.get_presences_view().values()),
+        "messages": len(cache.get_messages_view()),
+        "users": len(cache.get_users_view()),
+    }
+    minutes = max(time.monotonic() - metrics.started, 1.0) / 60
+    events = [f"`{event}` {count / minutes:,.1f}/min"
+              for event, count in metrics.gateway_events.most_common(10)]
+    description = (f"Profile: **{profile}**\nIntents: `{intents!r}`\nCache: `{cache_components!r}`\n"
+                   f"Resident memory: **{resident_memory() / 2 ** 20:,.1f} MiB**\n"
+                   f"Cached: " + ", ".join(f"{count:,} {name}" for name, count in cached.items()) + "\n"
+                   f"Gateway events: **{sum(metrics.gateway_events.values()) / minutes:,.1f}/min**\n"
+                   + "\n".join(events))
+    await ctx.respond(embed=hikari.Embed(title="Runtime Profile", description=description))
+
+
+@plugin.command
+@lightbulb.option("action", "Turn the monitor on or off, or show the worst stalls.", str,
+                  choices=("on", "off", "status"), default="status")
+@lightbulb.command("lagmonitor", "Controls the event loop lag monitor.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def lag_monitor_command(ctx: lightbulb.Context):
+    if ctx.options.action == "on":
+        lag_monitor.start()
+    elif ctx.options.action == "off":
+        lag_monitor.stop()
+
+    lines = [f"**{stall.duration * 1000:.0f}ms** <t:{int(stall.at)}:R> in `{stall.handler}`"
+             for stall in lag_monitor.worst()]
+    description = f"Monitor is **{'on' if lag_monitor.running else 'off'}**, " \
+                  f"reporting stalls over {lag_monitor.threshold * 1000:.0f}ms.\n" + "\n".join(lines)
+    await ctx.respond(embed=hikari.Embed(title="Event Loop Lag", description=description))
+
+
 @plugin.command
 @lightbulb.option("file_name", "file name", str)
 @lightbulb.command("reload", "Reloads an extension.")
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
 async def reload_extensions_command(ctx: lightbulb.Context):
     try:
-        plugin.bot.unload_extensions(f"components." + ctx.options.file_name)
-        plugin.bot.load_extensions(f"components." + ctx.options.file_name)
+        await plugin.bot.reload_extension(f"components." + ctx.options.file_name)
         await ctx.respond(f"Reloaded `{ctx.options.file_name}`")
 
     except lightbulb.errors.ExtensionAlreadyLoaded:
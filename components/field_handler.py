@@ -1,16 +1,186 @@
+import asyncio
 import hikari
 import lightbulb
 import random
+import struct
+import sys
+import time
+from array import array
+from collections import deque, namedtuple
+from functools import lru_cache, partial
+from itertools import islice
+from Combat import Combat, ONGOING, WON, LOST, RETREATED, MAX_TURN_ACTIONS
 from Database import Database
+from Leaderboard import leaderboard
+from Metrics import metrics
 import miru
+from Session import session_store, session_registry, move_log
 from components.error_handler import OutOfBoundError, BarrierTraverseError
 
 plugin = lightbulb.Plugin("Field")
 plugin.add_checks(lightbulb.checks.has_guild_permissions(hikari.Permissions.ADMINISTRATOR))
 
+# The field grid only stores one byte per cell, these are mapped to their emoji when the field is rendered.
+TREE, EXIT, PLAYER, BUFF, BOSS, BARRIER = range(6)
+TILE_PALETTE = (
+    '🌴',
+    '🕳️',
+    '<:cute:664406344824258560>',
+    '<a:gold:907835366726336543>',
+    '🐭',
+    '⛰️',
+)
+ENCODED_PALETTE = tuple(tile.encode() for tile in TILE_PALETTE)
+
+# version, size_x, size_y, buff_tile, level, start_x, start_y, boss alive, remaining buffs, level seed, viewport,
+# buffs held, in a boss fight; followed by the buff cells and the state of the fight, if any. Version 1 snapshots
+# were written before levels had a seed, version 2 before viewports and version 3 before boss fights.
+SNAPSHOT_HEADERS = {
+    1: struct.Struct('<BHHHIHHBH'),
+    2: struct.Struct('<BHHHIHHBHQ'),
+    3: struct.Struct('<BHHHIHHBHQB'),
+    4: struct.Struct('<BHHHIHHBHQBIB'),
+}
+SNAPSHOT_CELL = struct.Struct('<HH')
+SNAPSHOT_VERSION = 4
+
+# Fields with more cells than this place their buffs by rejection sampling instead of listing every free cell.
+LARGE_FIELD_CELLS = 4096
+
+# A ready-made level: the seed it was generated from, its buff cells and the grid and rows rendered at its start.
+Layout = namedtuple('Layout', 'seed buff_coordinates grid rows')
+
+
+@lru_cache(maxsize=64)
+def free_cells(size_x: int, size_y: int, blocked: frozenset):
+    """ Cells an event tile can be placed on, shared between every field of the same size. """
+    return tuple((x, y) for y in range(1, size_y) for x in range(1, size_x) if (x, y) not in blocked)
+
+
+# Steps tried when walking a distance map, in order of preference: up, right, down, left.
+STEPS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+TRAVEL_TARGETS = {'buff': "the nearest buff", 'exit': "the exit"}
+
+# One byte codes of everything a player can do to a field, these are what the move log stores.
+MOVE_UP, MOVE_RIGHT, MOVE_DOWN, MOVE_LEFT, TRAVEL_BUFF, TRAVEL_EXIT = range(6)
+# Fight actions are queued and only take effect on the next FIGHT_TURN, see `Field.fight`.
+FIGHT_ATTACK, FIGHT_HEALTH_POTION, FIGHT_STAMINA_POTION, FIGHT_BUFF, FIGHT_RETREAT, FIGHT_TURN = range(6, 12)
+
+
+def distance_map(size_x: int, size_y: int, blocked, targets):
+    """
+    Breadth-first search from every target at once. Returns the number of steps from each cell (indexed like the
+    field grid, from the top row down) to its nearest target, or -1 for cells that can't reach any target.
+    """
+    distances = array('i', [-1]) * (size_x * size_y)
+    queue = deque()
+    for x, y in targets:
+        distances[(size_y - y) * size_x + x - 1] = 0
+        queue.append((x, y))
+    while queue:
+        x, y = queue.popleft()
+        distance = distances[(size_y - y) * size_x + x - 1] + 1
+        for delta_x, delta_y in STEPS:
+            next_x, next_y = x + delta_x, y + delta_y
+            if 0 < next_x <= size_x and 0 < next_y <= size_y and (next_x, next_y) not in blocked:
+                index = (size_y - next_y) * size_x + next_x - 1
+                if distances[index] < 0:
+                    distances[index] = distance
+                    queue.append((next_x, next_y))
+    return distances
+
+
+@lru_cache(maxsize=64)
+def exit_distances(size_x: int, size_y: int, blocked: frozenset):
+    """ The exit and barriers don't move between levels, so fields of the same size share their exit distance map. """
+    return distance_map(size_x, size_y, blocked, ((size_x, size_y),))
+
+
+class Viewport:
+    """
+    Renders a `width` x `height` window of a field centred on the player and clamped to the edges of the map, so the
+    render cost doesn't depend on the size of the map. The window keeps its tiles and rendered rows, scrolling one
+    step only looks up the tiles of the one row or column that came into view.
+    """
+
+    def __init__(self, field: 'Field', width: int, height: int):
+        self.field = field
+        self.width = min(width, field.size_x)
+        self.height = min(height, field.size_y)
+        self.left = None
+        self.bottom = None
+        self.tiles = []
+        self.rows = []
+
+    def origin(self):
+        """ Returns the bottom left cell of the window around the player. """
+        field = self.field
+        left = min(max(field.start_x - self.width // 2, 1), field.size_x - self.width + 1)
+        bottom = min(max(field.start_y - self.height // 2, 1), field.size_y - self.height + 1)
+        return left, bottom
+
+    def tile_row(self, y: int):
+        return bytearray([self.field.tile_at(x, y) for x in range(self.left, self.left + self.width)])
+
+    def tile_column(self, x: int):
+        top = self.bottom + self.height - 1
+        return [self.field.tile_at(x, y) for y in range(top, self.bottom - 1, -1)]
+
+    def render_row(self, row: int):
+        return b' '.join([ENCODED_PALETTE[tile] for tile in self.tiles[row]]) + b'\n'
+
+    def render(self, dirty_cells: set, full: bool = False):
+        """ Brings the window up to date with the player's position and the changed `dirty_cells` of the field. """
+        left, bottom = self.origin()
+        if full or self.left is None or abs(left - self.left) + abs(bottom - self.bottom) > 1:
+            self.left, self.bottom = left, bottom
+            top = bottom + self.height - 1
+            self.tiles = [self.tile_row(y) for y in range(top, bottom - 1, -1)]
+            self.rows = [self.render_row(row) for row in range(self.height)]
+            return
+
+        dirty_rows = set()
+        if bottom > self.bottom:
+            # Scrolled up: the bottom row leaves the window and a new top row enters it.
+            self.bottom = bottom
+            del self.tiles[-1], self.rows[-1]
+            self.tiles.insert(0, self.tile_row(bottom + self.height - 1))
+            self.rows.insert(0, None)
+            dirty_rows.add(0)
+        elif bottom < self.bottom:
+            self.bottom = bottom
+            del self.tiles[0], self.rows[0]
+            self.tiles.append(self.tile_row(bottom))
+            self.rows.append(None)
+            dirty_rows.add(self.height - 1)
+        elif left > self.left:
+            # Scrolled right: every row drops its leftmost tile and gains the tile of the new column.
+            self.left = left
+            for tiles, tile in zip(self.tiles, self.tile_column(left + self.width - 1)):
+                del tiles[0]
+                tiles.append(tile)
+            dirty_rows.update(range(self.height))
+        elif left < self.left:
+            self.left = left
+            for tiles, tile in zip(self.tiles, self.tile_column(left)):
+                del tiles[-1]
+                tiles.insert(0, tile)
+            dirty_rows.update(range(self.height))
+
+        for x, y in dirty_cells:
+            if self.left <= x < self.left + self.width and self.bottom <= y < self.bottom + self.height:
+                row = self.bottom + self.height - 1 - y
+                self.tiles[row][x - self.left] = self.field.tile_at(x, y)
+                dirty_rows.add(row)
+        for row in dirty_rows:
+            self.rows[row] = self.render_row(row)
+
+    def memory_usage(self):
+        return sum(map(sys.getsizeof, self.tiles)) + sum(map(sys.getsizeof, self.rows))
+
 
 class Field:
-    def __init__(self, size_x: int, size_y: int, buff_tile: int, level: int):
+    def __init__(self, size_x: int, size_y: int, buff_tile: int, level: int, seed: int = None, viewport: int = None):
         self.text = None
         self.size_x = size_x
         self.size_y = size_y
@@ -19,76 +189,223 @@ class Field:
         self.exit_x = self.size_x
         self.exit_y = self.size_y
         self.boss_coordinates = [(self.size_x, self.size_y)]
-        self.barrier_coordinates = [(self.exit_x, self.exit_y - 1), (self.exit_x - 1, self.exit_y - 1)]
+        self.barrier_coordinates = {(self.exit_x, self.exit_y - 1), (self.exit_x - 1, self.exit_y - 1)}
         self.buff_tile = buff_tile
         self.level = level
-        self.field_text = ''
         self.description = ''
         self.event_description = f"Started a new game. You're currently at level {self.level}!"
         self.field = None
-        self.buff_coordinates = self.generate_event_tiles()
+        self.rows = []
+        self.dirty_cells = set()
+        self.full_render = True
+        self.rendered_position = None
+        self.seed = seed
+        self.buff_coordinates = set()
+        # BFS distance maps of the current level by travel target, see `distances`.
+        self.distance_maps = {}
+        # Fields too large to show in one embed are rendered through a `viewport` x `viewport` window instead.
+        self.viewport = Viewport(self, viewport, viewport) if viewport else None
+        if seed is None:
+            self.apply_layout(self.take_layout())
+        else:
+            self.generate_event_tiles(random.Random(seed))
         self.boss_fight_state = False
-
-    def generate_event_tiles(self):
+        self.combat = None
+        # Move codes of the fight actions queued for the next turn, and the buffs picked up so far.
+        self.fight_actions = []
+        self.buffs_held = 0
+        # Called with the field whenever `check_exit` moves it to the next level.
+        self.on_level_up = None
+
+    def snapshot(self):
+        """ Packs the progress of the field into a few bytes, the rendered grid is rebuilt on restore. """
+        header = SNAPSHOT_HEADERS[SNAPSHOT_VERSION].pack(
+            SNAPSHOT_VERSION, self.size_x, self.size_y, self.buff_tile, self.level, self.start_x, self.start_y,
+            bool(self.boss_coordinates), len(self.buff_coordinates), self.seed,
+            self.viewport.width if self.viewport is not None else 0, self.buffs_held, self.combat is not None
+        )
+        combat = self.combat.pack() if self.combat is not None else b''
+        return header + b''.join([SNAPSHOT_CELL.pack(x, y) for x, y in self.buff_coordinates]) + combat
+
+    @classmethod
+    def restore(cls, data: bytes):
+        header = SNAPSHOT_HEADERS.get(data[0])
+        if header is None:
+            raise ValueError(f"Unsupported field snapshot version {data[0]}.")
+        version, size_x, size_y, buff_tile, level, start_x, start_y, boss_alive, buffs, *rest = header.unpack_from(data)
+        seed = rest[0] if rest else random.getrandbits(63)
+        viewport = rest[1] if len(rest) > 1 else None
+        buffs_held, in_fight = rest[2:] if len(rest) > 2 else (0, False)
+
+        field = cls(size_x, size_y, buff_tile, level, seed=seed, viewport=viewport)
+        field.start_x, field.start_y = start_x, start_y
+        field.buff_coordinates = {SNAPSHOT_CELL.unpack_from(data, header.size + i * SNAPSHOT_CELL.size)
+                                  for i in range(buffs)}
+        field.buffs_held = buffs_held
+        if in_fight:
+            field.combat = Combat.unpack(level, seed, data, header.size + buffs * SNAPSHOT_CELL.size)
+            field.boss_fight_state = True
+        if not boss_alive:
+            field.boss_coordinates = []
+        field.event_description = f"Resumed your game at level {level}!"
+        return field
+
+    @classmethod
+    async def replay(cls, snapshot: bytes, moves: bytes):
+        """ Rebuilds a field from a move log checkpoint and the move codes played after it. """
+        field = cls.restore(snapshot)
+        for move in moves:
+            await field.play(move)
+        field.event_description = f"Resumed your game at level {field.level}!"
+        return field
+
+    async def play(self, move: int):
+        """ Applies a move code, see MOVE_ACTIONS. The player can't move or travel during a boss fight. """
+        if self.boss_fight_state and move < FIGHT_ATTACK:
+            self.description = "**You can't leave in the middle of a boss fight, retreat first!**"
+            await self.generate_field()
+            return
+        await MOVE_ACTIONS[move](self)
+
+    def memory_usage(self):
+        """ Approximate bytes held by the grid and the cached rows of the field. """
+        field = sys.getsizeof(self.field) if self.field is not None else 0
+        viewport = self.viewport.memory_usage() if self.viewport is not None else 0
+        return field + viewport + sys.getsizeof(self.rows) + sum(map(sys.getsizeof, self.rows))
+
+    def take_layout(self):
+        # Viewport fields never render the whole grid, so their layouts aren't pre-rendered either.
+        return level_pool.take(self.size_x, self.size_y, self.buff_tile, render=self.viewport is None)
+
+    def apply_layout(self, layout: Layout):
+        """ Starts a level from a ready-made layout, reusing its pre-rendered grid while the boss is still alive. """
+        self.seed = layout.seed
+        self.buff_coordinates = set(layout.buff_coordinates)
+        self.distance_maps.clear()
+        if layout.grid is not None and self.boss_coordinates and self.start_x == 1 and self.start_y == 1:
+            self.field = bytearray(layout.grid)
+            self.rows = list(layout.rows)
+            self.rendered_position = (1, 1)
+            self.dirty_cells.clear()
+            self.full_render = False
+        else:
+            self.full_render = True
+
+    def blocked_cells(self):
+        """ Cells an event tile can't be placed on: the start, the boss and the barriers. """
+        return frozenset([(1, 1), self.boss_coordinates[0]]) | self.barrier_coordinates
+
+    def generate_event_tiles(self, rng: random.Random = random):
         """ This sets the coordinates of the event buffs in the field. """
-        buff_tiles = []
-        while True:
-            x, y = random.choice(range(1, self.size_x)), random.choice(range(1, self.size_y))
-            if (x, y) in [(1, 1), self.boss_coordinates[0]] + self.barrier_coordinates:
-                continue
-            if (x, y) in buff_tiles:
-                continue
-            buff_tiles.append((x, y))
-
-            # Breaks when all the buff tiles are already generated for current level field without modifying the buff tile values.
-            if len(buff_tiles) == self.buff_tile:
-                break
-        self.buff_coordinates = buff_tiles
-        return buff_tiles
+        blocked = self.blocked_cells()
+        area = (self.size_x - 1) * (self.size_y - 1)
+        if area > LARGE_FIELD_CELLS and self.buff_tile + len(blocked) <= area:
+            # Listing every free cell of a large field costs far more than sampling a few spare cells, enough to
+            # still have `buff_tile` of them once the blocked ones are dropped.
+            width = self.size_x - 1
+            cells = ((index % width + 1, index // width + 1)
+                     for index in rng.sample(range(area), self.buff_tile + len(blocked)))
+            self.buff_coordinates = set(islice((cell for cell in cells if cell not in blocked), self.buff_tile))
+            return self.buff_coordinates
+
+        cells = free_cells(self.size_x, self.size_y, blocked)
+        if self.buff_tile > len(cells):
+            raise ValueError(f"Cannot place {self.buff_tile} buff tiles on a field with {len(cells)} free cells.")
+
+        self.buff_coordinates = set(rng.sample(cells, self.buff_tile))
+        return self.buff_coordinates
 
     async def generate_field(self):
         """
-        This first populates the entire x * y field with trees.
-        Then it replaces trees in the event coordinates with their respective event.
+        The first render (and every new level) populates the entire x * y field with trees and then
+        replaces trees in the event coordinates with their respective event.
+        Afterwards only the cells marked dirty since the previous render are redrawn, and only the rows
+        containing them are joined again. Fields with a viewport only ever render the window around the player.
         """
-        self.field = []
-        for _ in range(self.size_y):
-            self.field.append(['🌴' for _ in range(self.size_x)])
-
         await self.check_event()
 
-        try:
-            if not self.size_y >= self.start_y > 0:
-                raise IndexError
-            if not self.size_x >= self.start_x > 0:
-                raise IndexError
-
-            self.field[-self.exit_y][self.exit_x - 1] = '🕳️'
-            self.field[-self.start_y][self.start_x - 1] = '<:cute:664406344824258560>'
-
-            if self.buff_coordinates:
-                for x, y in self.buff_coordinates:
-                    self.field[-y][x - 1] = '<a:gold:907835366726336543>'
-            if self.boss_coordinates:
-                for x, y in self.boss_coordinates:
-                    self.field[-y][x - 1] = '🐭'
-                self.field[-(self.exit_y - 1)][self.exit_x - 1] = '⛰️'
-                self.field[-(self.exit_y - 1)][self.exit_x - 2] = '⛰️'
-
-        except IndexError:
+        if not self.size_y >= self.start_y > 0 or not self.size_x >= self.start_x > 0:
             raise IndexError("Starting coordinate should be within the x & y field boundaries.")
 
-        self.field_text = ''
-        for i in self.field:
-            self.field_text += f"{' '.join(i)}\n"
+        if self.viewport is not None:
+            self.dirty_cells.add((self.start_x, self.start_y))
+            if self.rendered_position is not None:
+                self.dirty_cells.add(self.rendered_position)
+            self.viewport.render(self.dirty_cells, full=self.full_render)
+            self.dirty_cells.clear()
+            self.full_render = False
+        elif self.full_render or self.field is None:
+            self.render_full()
+        else:
+            self.render_dirty()
+        self.rendered_position = (self.start_x, self.start_y)
         await self.text_generator()
 
+    @property
+    def field_text(self):
+        # Joined on access rather than stored, so each field only keeps one (utf-8 encoded) copy of its rendered rows.
+        rows = self.viewport.rows if self.viewport is not None else self.rows
+        return b''.join(rows).decode()
+
+    def index(self, x: int, y: int):
+        """ Converts a (x, y) coordinate into its offset in the field grid, which is stored from the top row down. """
+        return (self.size_y - y) * self.size_x + x - 1
+
+    def set_tile(self, x: int, y: int, tile: int):
+        self.field[self.index(x, y)] = tile
+
+    def render_row(self, row: int):
+        tiles = self.field[row * self.size_x:(row + 1) * self.size_x]
+        return b' '.join([ENCODED_PALETTE[tile] for tile in tiles]) + b'\n'
+
+    def tile_at(self, x: int, y: int):
+        """ Returns the tile drawn at (x, y), following the draw order exit < player < buff < boss < barrier. """
+        if self.boss_coordinates:
+            if (x, y) in self.barrier_coordinates:
+                return BARRIER
+            if (x, y) in self.boss_coordinates:
+                return BOSS
+        if (x, y) in self.buff_coordinates:
+            return BUFF
+        if x == self.start_x and y == self.start_y:
+            return PLAYER
+        if x == self.exit_x and y == self.exit_y:
+            return EXIT
+        return TREE
+
+    def render_full(self):
+        self.field = bytearray(self.size_x * self.size_y)
+
+        event_cells = [(self.exit_x, self.exit_y), (self.start_x, self.start_y)] + list(self.buff_coordinates)
+        if self.boss_coordinates:
+            event_cells += self.boss_coordinates + list(self.barrier_coordinates)
+        for x, y in event_cells:
+            self.set_tile(x, y, self.tile_at(x, y))
+
+        self.rows = [self.render_row(row) for row in range(self.size_y)]
+        self.dirty_cells.clear()
+        self.full_render = False
+
+    def render_dirty(self):
+        self.dirty_cells.add(self.rendered_position)
+        self.dirty_cells.add((self.start_x, self.start_y))
+
+        dirty_rows = set()
+        for x, y in self.dirty_cells:
+            if self.size_x >= x > 0 and self.size_y >= y > 0:
+                self.set_tile(x, y, self.tile_at(x, y))
+                dirty_rows.add(self.size_y - y)
+        for row in dirty_rows:
+            self.rows[row] = self.render_row(row)
+        self.dirty_cells.clear()
+
     async def text_generator(self):
         self.text = ''
         if self.event_description:
             self.text += f'> **{self.event_description}**\n'
             self.event_description = ''
         self.text += f'> {self.description}\n' if self.description else ''
+        self.text += f'> {self.combat.status()}\n' if self.combat is not None else ''
 
     async def move(self, delta_x: int = 0, delta_y: int = 0):
         self.start_x += delta_x
@@ -127,6 +444,62 @@ class Field:
         await self.move(delta_y=-1)
         await self.move_validation(before_x, before_y, "down")
 
+    def distances(self, target: str):
+        """
+        Returns the distance map of a travel target. It's computed once and reused until `check_exit` starts a new
+        level, except for the buff map which is dropped whenever a buff is picked up.
+        """
+        distances = self.distance_maps.get(target)
+        if distances is None:
+            if target == 'exit':
+                distances = exit_distances(self.size_x, self.size_y, frozenset(self.barrier_coordinates))
+            else:
+                blocked = self.barrier_coordinates | {(self.exit_x, self.exit_y)}
+                distances = distance_map(self.size_x, self.size_y, blocked, self.buff_coordinates)
+            self.distance_maps[target] = distances
+        return distances
+
+    def path_to(self, target: str):
+        """ Returns the (delta_x, delta_y) steps of a shortest path to `target`, or None if it can't be reached. """
+        distances = self.distances(target)
+        x, y = self.start_x, self.start_y
+        distance = distances[self.index(x, y)]
+        if distance < 0:
+            return None
+
+        steps = []
+        while distance > 0:
+            for delta_x, delta_y in STEPS:
+                next_x, next_y = x + delta_x, y + delta_y
+                if 0 < next_x <= self.size_x and 0 < next_y <= self.size_y \
+                        and distances[self.index(next_x, next_y)] == distance - 1:
+                    break
+            steps.append((delta_x, delta_y))
+            x, y, distance = next_x, next_y, distance - 1
+        return steps
+
+    async def travel_to(self, target: str):
+        """
+        Walks a shortest path to `target` ("buff" or "exit") in one action. Every tile on the way is checked for
+        events like a single move would, but the field is only rendered once at the end.
+        """
+        steps = self.path_to(target)
+        if not steps:
+            self.description = f"**There's no path to {TRAVEL_TARGETS[target]}!**"
+            await self.generate_field()
+            return
+
+        level = self.level
+        for number, (delta_x, delta_y) in enumerate(steps, 1):
+            await self.move(delta_x, delta_y)
+            await self.check_exit()
+            if self.level != level or self.boss_fight_state:
+                break
+            if number < len(steps):
+                await self.check_event()
+        self.description = f"You've travelled {number} tiles to {TRAVEL_TARGETS[target]}."
+        await self.generate_field()
+
     async def check_out_of_bound(self, before_x: int, before_y: int):
         if self.size_y < self.start_y or self.start_y <= 0 or self.size_x < self.start_x or self.start_x <= 0:
             # Revert to original position if they're out of bound
@@ -142,41 +515,313 @@ class Field:
     async def check_exit(self):
         """
         Checks if you've moved to the next level, if so, restart from the starting coordinates (1, 1)
-        and regenerates a new level field.
+        and regenerates a new level field. The exit is guarded by the boss, which has to be defeated first.
         """
         if self.start_x == self.exit_x and self.start_y == self.exit_y:
+            if self.boss_coordinates:
+                await self.boss_encounter()
+                return
             self.level += 1
             self.start_x = 1
             self.start_y = 1
             self.event_description = f"**You're now at level {self.level:,}!**"
-            self.generate_event_tiles()
+            self.boss_coordinates = [(self.size_x, self.size_y)]
+            self.apply_layout(self.take_layout())
+            if self.on_level_up is not None:
+                self.on_level_up(self)
 
     async def boss_encounter(self):
-        if self.start_x == self.exit_x and self.start_y == self.exit_y:
+        if self.start_x == self.exit_x and self.start_y == self.exit_y and not self.boss_fight_state:
             self.boss_fight_state = True
+            self.combat = Combat(self.level, self.seed)
+            self.event_description = f"You've triggered a boss event."
+
+    async def queue_fight_action(self, move: int):
+        """ Queues a fight action for the next turn, returns False if the turn is already full. """
+        if len(self.fight_actions) >= MAX_TURN_ACTIONS:
+            return False
+        self.fight_actions.append(move)
+        return True
+
+    async def fight(self):
+        """
+        Resolves the queued fight actions, each with the boss's reply, and renders the field once. Defeating the
+        boss clears the exit, losing sends the player back to the start and retreating steps back from the exit.
+        Returns the move codes of the actions that were resolved.
+        """
+        moves, self.fight_actions = self.fight_actions, []
+        if not self.boss_fight_state:
+            self.description = "**There's no boss to fight here!**"
+            await self.generate_field()
+            return moves
+
+        turn = self.combat.resolve([move - FIGHT_ATTACK for move in moves], self.buffs_held)
+        self.buffs_held -= turn.buffs_used
+        self.description = '\n> '.join(turn.log)
+        if turn.outcome != ONGOING:
+            self.boss_fight_state = False
+            self.combat = None
+        if turn.outcome == WON:
+            # The next level brings a new boss along.
+            self.boss_coordinates = []
+            await self.check_exit()
+        elif turn.outcome == LOST:
+            self.start_x, self.start_y = 1, 1
+            self.event_description = "You've been sent back to the start."
+        elif turn.outcome == RETREATED:
+            self.start_x -= 1
+        await self.generate_field()
+        return moves
 
     async def check_event(self):
         if (self.start_x, self.start_y) in self.buff_coordinates:
             self.buff_coordinates.remove((self.start_x, self.start_y))
+            self.buffs_held += 1
+            self.distance_maps.pop('buff', None)
+            self.dirty_cells.add((self.start_x, self.start_y))
             self.event_description = f"You've triggered a buff event."
-        if self.start_y == self.size_y and self.start_x == self.size_x:
-            self.boss_coordinates.remove((self.size_x, self.size_y))
-            self.event_description = f"You've triggered a boss event."
+
+
+MOVE_ACTIONS = (
+    Field.move_up,
+    Field.move_right,
+    Field.move_down,
+    Field.move_left,
+    partial(Field.travel_to, target='buff'),
+    partial(Field.travel_to, target='exit'),
+    partial(Field.queue_fight_action, move=FIGHT_ATTACK),
+    partial(Field.queue_fight_action, move=FIGHT_HEALTH_POTION),
+    partial(Field.queue_fight_action, move=FIGHT_STAMINA_POTION),
+    partial(Field.queue_fight_action, move=FIGHT_BUFF),
+    partial(Field.queue_fight_action, move=FIGHT_RETREAT),
+    Field.fight,
+)
+
+
+def generate_layout(size_x: int, size_y: int, buff_tile: int, seed: int, render: bool = True):
+    """ Generates and renders the start of a level, the same seed always gives the same layout. """
+    field = Field(size_x, size_y, buff_tile, 0, seed=seed)
+    if not render:
+        return Layout(seed, frozenset(field.buff_coordinates), None, None)
+    field.render_full()
+    return Layout(seed, frozenset(field.buff_coordinates), bytes(field.field), tuple(field.rows))
+
+
+class LevelPool:
+    """
+    Keeps up to `size` ready-made layouts per (size_x, size_y, buff_tile, render), so starting a level only has to take one.
+    Once a pool drops below `low_water` it is refilled in the background. Every layout has its own seed, which is
+    kept on the field so a reported level can be generated again with `generate_layout`.
+    """
+
+    def __init__(self, size: int = 8, low_water: int = 4):
+        self.size = size
+        self.low_water = low_water
+        self.layouts = {}
+        self.refills = {}
+
+    def take(self, size_x: int, size_y: int, buff_tile: int, render: bool = True):
+        key = (size_x, size_y, buff_tile, render)
+        layouts = self.layouts.setdefault(key, deque())
+        layout = layouts.popleft() if layouts else generate_layout(size_x, size_y, buff_tile, random.getrandbits(63),
+                                                                   render)
+
+        if len(layouts) < self.low_water and key not in self.refills:
+            try:
+                self.refills[key] = asyncio.get_running_loop().create_task(self.refill(key))
+            except RuntimeError:
+                # No running event loop (e.g. in scripts), layouts are then generated on demand.
+                pass
+        return layout
+
+    async def refill(self, key: tuple):
+        size_x, size_y, buff_tile, render = key
+        try:
+            layouts = self.layouts[key]
+            while len(layouts) < self.size:
+                layouts.append(generate_layout(size_x, size_y, buff_tile, random.getrandbits(63), render))
+                # Generate one layout per loop iteration so interactions aren't held up by a whole refill.
+                await asyncio.sleep(0)
+        finally:
+            del self.refills[key]
+
+
+level_pool = LevelPool()
 
 
 class View(miru.View):
-    def __init__(self, lb_ctx: lightbulb.Context, field: Field):
+    def __init__(self, lb_ctx: lightbulb.Context, field: Field, coalesce: bool = True, coalesce_window: float = 0.35,
+                 max_pending: int = 5, stale_after: float = 2.0):
         self.lb_ctx = lb_ctx
         self.value = None
         self.field = field
         self.ctx: miru.Context = None
+        self.session_key = (lb_ctx.guild_id or 0, lb_ctx.author.id)
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.pending_ctx: miru.Context = None
+        self.edit_task: asyncio.Task = None
+        # Edits are sent one at a time, so they can't reach Discord out of order.
+        self.edit_lock = asyncio.Lock()
+        self.last_edit = float("-inf")
+        self.actions = asyncio.Queue(maxsize=max_pending)
+        self.stale_after = stale_after
+        self.worker: asyncio.Task = None
+        self.dropped_actions = 0
+        self.turn_pending = False
+        self.stopped = False
+        # Actions applied to the field and how many of them the last render showed, see `export_state`.
+        self.played = 0
+        self.rendered = 0
+        self.suspend_task: asyncio.Task = None
+        field.on_level_up = self.level_up
         super().__init__(timeout=300)
 
+    def stop(self) -> None:
+        # Button callbacks that were waiting on the action queue leave the message alone once the view is stopped.
+        self.stopped = True
+        super().stop()
+
+    def suspend(self):
+        """ Stops the view of a game evicted by the session registry and takes the buttons off its message. """
+        self.stop()
+        if self.message is not None:
+            self.suspend_task = asyncio.create_task(self.show_suspended())
+
+    async def show_suspended(self):
+        if self.edit_task is not None and not self.edit_task.done():
+            await self.edit_task
+        try:
+            await self.message.edit(content="Game was paused. Use /start to resume it.", components=[])
+        except hikari.HTTPError:
+            pass
+
+    def level_up(self, field: Field):
+        guild_id, user_id = self.session_key
+        leaderboard.record(guild_id, user_id, field.level)
+
+    async def submit(self, action):
+        """
+        Queues an action that mutates the field and waits for the session's worker to run it, so actions of one
+        session never interleave. Returns False if the action was dropped because the queue was full or because
+        it waited longer than `stale_after` seconds, miru then only acknowledges the interaction.
+        """
+        if self.actions.full():
+            self.dropped_actions += 1
+            return False
+
+        done = asyncio.get_running_loop().create_future()
+        self.actions.put_nowait((action, time.monotonic(), done))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.process_actions())
+        return await done
+
+    async def process_actions(self):
+        while not self.actions.empty():
+            action, queued_at, done = self.actions.get_nowait()
+            if time.monotonic() - queued_at > self.stale_after:
+                self.dropped_actions += 1
+                done.set_result(False)
+                continue
+            try:
+                await action()
+            except Exception as error:
+                done.set_exception(error)
+            else:
+                done.set_result(True)
+
+    async def render(self, ctx: miru.Context):
+        self.rendered = self.played
+        embed = hikari.Embed(description=self.field.field_text)
+        embed.set_footer(text=f"Played by {self.lb_ctx.author}", icon=str(self.lb_ctx.author.display_avatar_url))
+        await ctx.edit_response(content=self.field.text, embed=embed, components=self.build(),
+                                flags=hikari.MessageFlag.EPHEMERAL)
+
+    async def play(self, move: int):
+        await self.field.play(move)
+        self.played += 1
+        if move_log.enabled:
+            move_log.record(self.session_key, self.field, move)
+
+    async def play_turn(self):
+        self.turn_pending = False
+        moves = await self.field.fight()
+        self.played += 1
+        if move_log.enabled:
+            move_log.record(self.session_key, self.field, *moves, FIGHT_TURN)
+
+    async def handle_move(self, ctx: miru.Context, move: int):
+        """
+        Applies the move code to the field through the action queue. When coalescing, a press is shown right away if no
+        edit is in flight or went out within the last `coalesce_window`. Otherwise the interaction is only acknowledged
+        (which doesn't count against the bot's global rate limit) and the message edit is left to `flush_edits`.
+        """
+        if not await self.submit(partial(self.play, move)):
+            return
+        await self.respond(ctx)
+
+    async def handle_fight(self, ctx: miru.Context, move: int):
+        """
+        Queues a fight action. Actions pressed before the queued ones get their go in the action queue are resolved
+        in the same `Field.fight` step, each answered by the boss, so they all share a single render and edit.
+        """
+        if not await self.field.queue_fight_action(move):
+            self.dropped_actions += 1
+            return
+        if self.turn_pending:
+            return
+        self.turn_pending = True
+        if not await self.submit(self.play_turn):
+            self.turn_pending = False
+            return
+        await self.respond(ctx)
+
+    async def respond(self, ctx: miru.Context):
+        if self.stopped:
+            return
+        if not move_log.enabled:
+            session_store.mark_dirty(self.session_key, self.field)
+        if not self.coalesce:
+            await self.render(ctx)
+            return
+        if not self.edit_lock.locked() and self.pending_ctx is None \
+                and time.monotonic() - self.last_edit >= self.coalesce_window:
+            async with self.edit_lock:
+                self.last_edit = time.monotonic()
+                await self.render(ctx)
+            return
+
+        await ctx.defer()
+        self.pending_ctx = ctx
+        if self.edit_task is None or self.edit_task.done():
+            self.edit_task = asyncio.create_task(self.flush_edits())
+
+    async def flush_edits(self):
+        """
+        Sends at most one edit per `coalesce_window` with the latest state of the field,
+        moves made while an edit is in flight or within the window are folded into the next one.
+        """
+        while self.pending_ctx is not None:
+            await asyncio.sleep(max(self.last_edit + self.coalesce_window - time.monotonic(), 0))
+            async with self.edit_lock:
+                ctx, self.pending_ctx = self.pending_ctx, None
+                self.last_edit = time.monotonic()
+                metrics.begin("view", "coalesced_edit", ctx)
+                try:
+                    await self.render(ctx)
+                except Exception as error:
+                    metrics.finish(ctx, "error")
+                    await self.on_error(error, context=ctx)
+                else:
+                    metrics.finish(ctx)
+
     async def view_check(self, ctx: miru.Context) -> bool:
         self.ctx = ctx
+        session_registry.touch(self.session_key)
         return self.lb_ctx.author == ctx.user
 
     async def on_timeout(self) -> None:
+        session_registry.evict(self.session_key, view=self)
         i = 0
         for button in self.children:
             if not i:
@@ -187,62 +832,123 @@ class View(miru.View):
                 i += 1
                 continue
             self.remove_item(button)
-            await self.ctx.edit_response(content="Game has timed out. Please restart the command.", components=[])
-
-    @miru.button(style=hikari.ButtonStyle.SECONDARY, emoji=hikari.Emoji.parse("<:432536324252:960939610098249820>"),
-                 row=1)
+            if self.ctx is not None:
+                await self.ctx.edit_response(content="Game has timed out. Please restart the command.", components=[])
+            elif self.message is not None:
+                # A view re-attached by `import_state` that nobody pressed a button on since.
+                await self.message.edit(content="Game has timed out. Please restart the command.", components=[])
+
+    @miru.button(custom_id="field:top_left_health_potion_button", style=hikari.ButtonStyle.SECONDARY,
+                 emoji=hikari.Emoji.parse("<:432536324252:960939610098249820>"), row=1)
+    @metrics.timed_callback
     async def top_left_health_potion_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        pass
+        await self.handle_fight(ctx, FIGHT_HEALTH_POTION)
 
-    @miru.button(style=hikari.ButtonStyle.PRIMARY, emoji="🔼", row=1)
+    @miru.button(custom_id="field:up_button", style=hikari.ButtonStyle.PRIMARY, emoji="🔼", row=1)
+    @metrics.timed_callback
     async def up_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        await self.field.move_up()
-        embed = hikari.Embed(description=self.field.field_text)
-        embed.set_footer(text=f"Played by {self.lb_ctx.author}", icon=str(self.lb_ctx.author.display_avatar_url))
-        await ctx.edit_response(content=self.field.text, embed=embed, components=self.build(),
-                                flags=hikari.MessageFlag.EPHEMERAL)
+        await self.handle_move(ctx, MOVE_UP)
 
-    @miru.button(style=hikari.ButtonStyle.SECONDARY,
+    @miru.button(custom_id="field:top_right_stamina_potion_button", style=hikari.ButtonStyle.SECONDARY,
                  emoji=hikari.Emoji.parse("<a:927159465332051998:960935542491586570>"), row=1)
+    @metrics.timed_callback
     async def top_right_stamina_potion_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        pass
+        await self.handle_fight(ctx, FIGHT_STAMINA_POTION)
 
-    @miru.button(style=hikari.ButtonStyle.PRIMARY, emoji="◀", row=2)
+    @miru.button(custom_id="field:left_button", style=hikari.ButtonStyle.PRIMARY, emoji="◀", row=2)
+    @metrics.timed_callback
     async def left_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        await self.field.move_left()
-        embed = hikari.Embed(description=self.field.field_text)
-        embed.set_footer(text=f"Played by {self.lb_ctx.author}", icon=str(self.lb_ctx.author.display_avatar_url))
-        await ctx.edit_response(content=self.field.text, embed=embed, components=self.build(),
-                                flags=hikari.MessageFlag.EPHEMERAL)
+        await self.handle_move(ctx, MOVE_LEFT)
 
-    @miru.button(style=hikari.ButtonStyle.SECONDARY, emoji=hikari.Emoji.parse("<a:Attack:769715971421896734>"), row=2)
+    @miru.button(custom_id="field:middle_attack_button", style=hikari.ButtonStyle.SECONDARY,
+                 emoji=hikari.Emoji.parse("<a:Attack:769715971421896734>"), row=2)
+    @metrics.timed_callback
     async def middle_attack_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        pass
+        await self.handle_fight(ctx, FIGHT_ATTACK)
 
-    @miru.button(style=hikari.ButtonStyle.PRIMARY, emoji="▶", row=2)
+    @miru.button(custom_id="field:right_button", style=hikari.ButtonStyle.PRIMARY, emoji="▶", row=2)
+    @metrics.timed_callback
     async def right_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        await self.field.move_right()
-        embed = hikari.Embed(description=self.field.field_text)
-        embed.set_footer(text=f"Played by {self.lb_ctx.author}", icon=str(self.lb_ctx.author.display_avatar_url))
-        await ctx.edit_response(content=self.field.text, embed=embed, components=self.build(),
-                                flags=hikari.MessageFlag.EPHEMERAL)
+        await self.handle_move(ctx, MOVE_RIGHT)
 
-    @miru.button(style=hikari.ButtonStyle.SECONDARY, emoji=hikari.Emoji.parse("<a:kleeRun:861497168112517150>"), row=3)
+    @miru.button(custom_id="field:bottom_left_retreat_button", style=hikari.ButtonStyle.SECONDARY,
+                 emoji=hikari.Emoji.parse("<a:kleeRun:861497168112517150>"), row=3)
+    @metrics.timed_callback
     async def bottom_left_retreat_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        pass
+        await self.handle_fight(ctx, FIGHT_RETREAT)
 
-    @miru.button(style=hikari.ButtonStyle.PRIMARY, emoji="🔽", row=3)
+    @miru.button(custom_id="field:down_button", style=hikari.ButtonStyle.PRIMARY, emoji="🔽", row=3)
+    @metrics.timed_callback
     async def down_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        await self.field.move_down()
-        embed = hikari.Embed(description=self.field.field_text)
-        embed.set_footer(text=f"Played by {self.lb_ctx.author}", icon=str(self.lb_ctx.author.display_avatar_url))
-        await ctx.edit_response(content=self.field.text, embed=embed, components=self.build(),
-                                flags=hikari.MessageFlag.EPHEMERAL)
+        await self.handle_move(ctx, MOVE_DOWN)
 
-    @miru.button(style=hikari.ButtonStyle.SECONDARY,
+    @miru.button(custom_id="field:bottom_right_buff_button", style=hikari.ButtonStyle.SECONDARY,
                  emoji=hikari.Emoji.parse("<a:857039592074117120:960935540558028850>"), row=3)
+    @metrics.timed_callback
     async def bottom_right_buff_button(self, button: miru.Button, ctx: miru.Context) -> None:
-        pass
+        await self.handle_fight(ctx, FIGHT_BUFF)
+
+    @miru.button(custom_id="field:travel_buff_button", label="Nearest Buff", style=hikari.ButtonStyle.SUCCESS,
+                 emoji="✨", row=4)
+    @metrics.timed_callback
+    async def travel_buff_button(self, button: miru.Button, ctx: miru.Context) -> None:
+        await self.handle_move(ctx, TRAVEL_BUFF)
+
+    @miru.button(custom_id="field:travel_exit_button", label="Exit", style=hikari.ButtonStyle.SUCCESS,
+                 emoji="🕳️", row=4)
+    @metrics.timed_callback
+    async def travel_exit_button(self, button: miru.Button, ctx: miru.Context) -> None:
+        await self.handle_move(ctx, TRAVEL_EXIT)
+
+
+async def export_state(bot):
+    """
+    Called by `Yuna.reload_extension` before this module is reloaded. Stops the live game views once their queued
+    moves and edits are done and hands them over, together with the pre-generated layouts, to `import_state` of the
+    reloaded module.
+    """
+    sessions = []
+    for key, view in list(session_registry.live.items()):
+        if view.message is None:
+            continue
+        session_registry.evict(key, view=view)
+        view.stop()
+        # Presses answered by the worker don't start edits on a stopped view, edits started before are awaited.
+        if view.worker is not None and not view.worker.done():
+            await view.worker
+        if view.edit_task is not None and not view.edit_task.done():
+            await view.edit_task
+        sessions.append((key, view.lb_ctx, view.message, view.field, view.ctx, view.played != view.rendered))
+    return {"sessions": sessions, "layouts": level_pool.layouts}
+
+
+async def import_state(bot, state: dict):
+    """
+    Re-attaches the handed over games to their messages. The buttons have fixed custom ids, so the messages don't
+    need to be edited. The caches of this module are warmed up before any player gets to use them.
+    """
+    for key, layouts in state["layouts"].items():
+        level_pool.layouts.setdefault(key, deque()).extend(Layout(*layout) for layout in layouts)
+
+    for key, lb_ctx, message, old_field, ctx, unrendered in state["sessions"]:
+        field = Field.restore(old_field.snapshot())
+        field.fight_actions = list(old_field.fight_actions)
+        field.distances('exit')
+        if 'buff' in old_field.distance_maps:
+            field.distance_maps['buff'] = old_field.distance_maps['buff']
+        await field.generate_field()
+        field.text, field.description = old_field.text, old_field.description
+
+        view = View(lb_ctx, field)
+        view.ctx = ctx
+        view.start(message)
+        session_registry.add(key, view)
+        if unrendered and ctx is not None:
+            # Moves drained from the old view's queue after it was stopped haven't been shown yet.
+            try:
+                await view.render(ctx)
+            except hikari.HTTPError:
+                pass
 
 
 def load(bot):
@@ -0,0 +1,84 @@
+import hikari
+import lightbulb
+import miru
+from Metrics import metrics
+from Monitor import lag_monitor
+
+plugin = lightbulb.Plugin("Metrics")
+runner = None
+
+# Context methods that make Discord requests, timed as the REST phase of the interaction they belong to.
+REST_METHODS = (
+    (lightbulb.context.base.Context, ("edit_last_response", "delete_last_response")),
+    (lightbulb.ApplicationContext, ("respond",)),
+    (lightbulb.PrefixContext, ("respond",)),
+    (miru.Context, ("respond", "edit_response", "defer")),
+)
+
+
+@plugin.listener(lightbulb.CommandInvocationEvent)
+async def on_invocation(event: lightbulb.CommandInvocationEvent) -> None:
+    metrics.begin("command", event.command.name, event.context)
+
+
+@plugin.listener(lightbulb.CommandCompletionEvent)
+async def on_completion(event: lightbulb.CommandCompletionEvent) -> None:
+    metrics.finish(event.context)
+
+
+@plugin.listener(lightbulb.CommandErrorEvent)
+async def on_command_error(event: lightbulb.CommandErrorEvent) -> None:
+    metrics.finish(event.context, "error")
+
+
+async def prometheus_handler(request):
+    from aiohttp import web
+
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+@plugin.listener(hikari.StartedEvent)
+async def on_started(event: hikari.StartedEvent) -> None:
+    """ Serves the metrics in the Prometheus text format on http://127.0.0.1:<MetricsPort>/metrics. """
+    # aiohttp is only imported once the bot has started, so it doesn't add to the extension load time.
+    from aiohttp import web
+
+    global runner
+    config = plugin.bot.d.config or {}
+    if config.get("LagMonitor", False):
+        lag_monitor.start()
+    if plugin.bot.d.worker is not None:
+        # Workers started by Supervisor.py report their metrics to the supervisor, which serves them combined.
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", config.get("MetricsPort", 9100)).start()
+
+
+@plugin.listener(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent) -> None:
+    global runner
+    lag_monitor.stop()
+    if runner is not None:
+        await runner.cleanup()
+        runner = None
+
+
+@plugin.listener(hikari.ShardPayloadEvent)
+async def on_shard_payload(event: hikari.ShardPayloadEvent) -> None:
+    """ Counts every event the shards receive, including the ones nothing else listens to. """
+    metrics.gateway_events[event.name] += 1
+
+
+def load(bot):
+    for cls, names in REST_METHODS:
+        metrics.time_rest(cls, *names)
+    bot.add_plugin(plugin)
+
+
+def unload(bot):
+    for cls, names in REST_METHODS:
+        metrics.untime_rest(cls, *names)
+    bot.remove_plugin(plugin)
@@ -0,0 +1,29 @@
+import hikari
+import lightbulb
+from lightbulb.ext import tasks
+from Session import move_log, flush_all
+
+plugin = lightbulb.Plugin("Sessions")
+
+
+@tasks.task(s=15, auto_start=True)
+async def flush_sessions():
+    # Failures are logged by `flush_all`, so a database outage can't use up the task's consecutive failures.
+    await flush_all()
+
+
+@plugin.listener(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent) -> None:
+    # Persist anything the interval task hasn't written yet before the database pool is closed.
+    await flush_all()
+
+
+def load(bot):
+    # `MoveLog: true` persists games as a log of their moves instead of rewriting a snapshot after every move.
+    move_log.enabled = bool((bot.d.config or {}).get("MoveLog", False))
+    bot.add_plugin(plugin)
+
+
+def unload(bot):
+    flush_sessions.cancel()
+    bot.remove_plugin(plugin)
@@ -1,11 +1,19 @@
 import hikari
 import lightbulb
 import random
-from components.field_handler import View, Field
+from Leaderboard import leaderboard
+from Metrics import metrics
+from Session import session_store, session_registry, move_log
 
 
 plugin = lightbulb.Plugin("Admin Commands")
 
+# (size_x, size_y, buff_tile, level, viewport) of a new game, large worlds only show the window around the player.
+WORLDS = {
+    "small": (12, 12, 15, 3, None),
+    "large": (128, 128, 300, 3, 9),
+}
+
 
 async def embed_creator(ctx: lightbulb.Context, title: str, description: str):
     colour = random.randint(0x0, 0xFFFFFF)
@@ -15,18 +23,76 @@ async def embed_creator(ctx: lightbulb.Context, title: str, description: str):
 
 
 @plugin.command()
+@lightbulb.option("world", "Starts a new game in a world of this size, leave it out to resume your game.", str,
+                  choices=tuple(WORLDS), required=False)
 @lightbulb.command("start", "Button to press on.")
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
 async def adventure_test(ctx: lightbulb.Context) -> None:
+    # Looked up on every call, so games started after `field_handler` is reloaded use its new version.
+    from components.field_handler import View, Field
 
-    field_object = Field(12, 12, 15, 3)
+    key = (ctx.guild_id or 0, ctx.author.id)
+    snapshot = session_registry.take(key)
+    new_game = ctx.options.world is not None
+    entry = None
+    if new_game:
+        snapshot = None
+    elif snapshot is None:
+        if move_log.enabled:
+            entry = await move_log.load(key)
+        else:
+            snapshot = await session_store.load(key)
+    if snapshot:
+        field_object = Field.restore(snapshot)
+    elif entry:
+        field_object = await Field.replay(*entry)
+    else:
+        size_x, size_y, buff_tile, level, viewport = WORLDS[ctx.options.world or "small"]
+        field_object = Field(size_x, size_y, buff_tile, level, viewport=viewport)
+        new_game = True
     await field_object.generate_field()
+    if move_log.enabled:
+        move_log.begin(key, field_object)
+    elif new_game:
+        # Replaces the stored session, including the one `take` just marked dirty.
+        session_store.mark_dirty(key, field_object)
     view = View(ctx, field_object)
     embed = hikari.Embed(description=field_object.field_text)
     embed.set_footer(text=f"Played by {ctx.author}", icon=str(ctx.author.display_avatar_url))
     proxy = await ctx.respond(content=field_object.text, embed=embed, components=view.build())
-    message = await proxy.message()
+    async with metrics.rest(ctx):
+        # Fetching the message the response created is a request of its own that goes through the response proxy.
+        message = await proxy.message()
     view.start(message)  # Start listening for interactions
+    session_registry.add(key, view)
+
+
+@plugin.command()
+@lightbulb.option("scope", "Show this server's leaderboard or the global one.", str, choices=("server", "global"),
+                  default="server")
+@lightbulb.command("leaderboard", "Shows the players who reached the highest levels.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def leaderboard_command(ctx: lightbulb.Context) -> None:
+    guild_id = ctx.guild_id if ctx.options.scope == "server" and ctx.guild_id else None
+    top = await leaderboard.top(guild_id)
+    lines = [f"**#{top.rank(-level)}** <@{user_id}> — level {-level:,}" for level, user_id in top.entries[:10]]
+    title = "Server Leaderboard" if guild_id else "Global Leaderboard"
+    await embed_creator(ctx, title, "\n".join(lines) or "Nobody has cleared a level yet.")
+
+
+@plugin.command()
+@lightbulb.option("user", "Player to look up, defaults to you.", hikari.User, required=False)
+@lightbulb.command("rank", "Shows a player's highest level and rank.")
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+async def rank_command(ctx: lightbulb.Context) -> None:
+    user = ctx.options.user or ctx.author
+    lines = []
+    for name, guild_id in (("Server", ctx.guild_id), ("Global", None)):
+        if name == "Server" and not guild_id:
+            continue
+        entry = await leaderboard.rank(guild_id, user.id)
+        lines.append(f"{name}: **#{entry[0]:,}** at level {entry[1]:,}" if entry else f"{name}: unranked")
+    await embed_creator(ctx, f"Rank of {user}", "\n".join(lines))
 
 
 def load(bot):
@@ -1,14 +1,42 @@
+import time
+
+STARTED = time.perf_counter()
+
+import asyncio
+import importlib
+import json
+import os
+import sys
 from abc import ABC
 import lightbulb
 import yaml
 import hikari
-from os import listdir
-from os.path import abspath
 import miru
 from lightbulb.ext import tasks
+from Database import Database
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_PATH = os.path.join(ROOT, ".extensions.json")
+
+# Extensions belonging to each feature, the `Features` list in authentication.yaml picks which ones are loaded.
+# Extensions that aren't part of any feature are always loaded.
+FEATURES = {
+    "game": ("components.field_handler", "components.user_commands", "components.session_handler"),
+    "admin": ("components.admin_commands", "components.error_handler"),
+    "metrics": ("components.metrics_handler",),
+}
+
+# How long the first import of each extension took, wherever it happened, for the startup report.
+import_times = {}
+
+
+def import_extension(extension: str):
+    if extension not in import_times:
+        started = time.perf_counter()
+        importlib.import_module(extension)
+        import_times[extension] = time.perf_counter() - started
+    return sys.modules[extension]
 
-with open("authentication.yaml", "r", encoding="utf8") as stream:
-    yaml_data = yaml.safe_load(stream)
 
 test_guilds = (
     948311226159624254,
@@ -19,27 +47,100 @@ test_guilds = (
 
 
 class Yuna(lightbulb.BotApp, ABC):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, stub_gateway: bool = False, stub_crash_after: float = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.stub_gateway = stub_gateway
+        self.stub_crash_after = stub_crash_after
+        if stub_gateway:
+            # Application commands can only be registered with Discord.
+            self.unsubscribe(hikari.StartedEvent, self._manage_application_commands)
+
+    async def start(self, **kwargs):
+        """ Starts the bot, on stub shards that never connect to Discord if `stub_gateway` is set. """
+        if not self.stub_gateway:
+            return await super().start(**kwargs)
+        from StubGateway import start_stub_gateway
+
+        await start_stub_gateway(self, kwargs.get("shard_ids"), kwargs.get("shard_count"), self.stub_crash_after)
 
     def load_configuration(self):
         self.load_all_extensions()
 
+    @staticmethod
+    def extension_manifest():
+        """
+        Lists the extensions in components/ and its subfolders. The list is cached in .extensions.json together with
+        the modification times of the modules, so modules are only read again when one of them changed.
+        """
+        modules = {}
+        for directory, package in [(os.path.join(ROOT, "components"), "components")] + [
+            (entry.path, f"components.{entry.name}") for entry in os.scandir(os.path.join(ROOT, "components"))
+            if entry.is_dir() and entry.name != "__pycache__"
+        ]:
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith(".py"):
+                    modules[f"{package}.{entry.name[:-3]}"] = (entry.path, entry.stat().st_mtime_ns)
+
+        mtimes = {name: mtime for name, (_, mtime) in modules.items()}
+        try:
+            with open(MANIFEST_PATH, "r", encoding="utf8") as stream:
+                manifest = json.load(stream)
+            if manifest["mtimes"] == mtimes:
+                return manifest["extensions"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        extensions = []
+        for name, (path, _) in sorted(modules.items()):
+            with open(path, "r", encoding="utf8") as stream:
+                if "\ndef load(" in stream.read():
+                    extensions.append(name)
+        try:
+            with open(MANIFEST_PATH, "w", encoding="utf8") as stream:
+                json.dump({"mtimes": mtimes, "extensions": extensions}, stream)
+        except OSError:
+            pass
+        return extensions
+
+    @staticmethod
+    def enabled_extensions(extensions: list, features: list = None):
+        if features is None:
+            return extensions
+        disabled = {name for feature, names in FEATURES.items() if feature not in features for name in names}
+        return [name for name in extensions if name not in disabled]
+
     def load_all_extensions(self):
-        for file in listdir(abspath("components/")):
-            if file != "__pycache__":
-                if file.endswith(".py"):
-                    file = "components." + file[:-3]
-                    self.load_extensions(file)
-                    print(f"Successfully loaded {file}")
-
-                else:
-                    for script in listdir(abspath(f"components/{file}/")):
-                        if script != "__pycache__":
-                            if script.endswith(".py"):
-                                loading_file = f"components.{file}." + script[:-3]
-                                self.load_extensions(loading_file)
-                                print(f"Successfully loaded {loading_file}")
+        timings = []
+        features = self.d.config.get("Features") if self.d.config else None
+        for extension in self.enabled_extensions(self.extension_manifest(), features):
+            # With the "minimal" profile, `runtime_profile` has already imported the extension and timed it.
+            import_extension(extension)
+            started = time.perf_counter()
+            self.load_extensions(extension)
+            timings.append((extension, import_times[extension], time.perf_counter() - started))
+
+        width = max([len(name) for name, _, _ in timings], default=0)
+        print(f"{'Extension':<{width}}  {'Import':>9}  {'Load':>9}")
+        for name, import_time, load_time in timings:
+            print(f"{name:<{width}}  {import_time * 1000:>7.1f}ms  {load_time * 1000:>7.1f}ms")
+        print(f"Loaded {len(timings)} extensions in {sum(a + b for _, a, b in timings) * 1000:.1f}ms, "
+              f"{(time.perf_counter() - STARTED) * 1000:.1f}ms since startup.")
+
+    async def reload_extension(self, extension: str):
+        """
+        Reloads an extension, handing its live state over to the new version of the module. An extension can define
+        `async def export_state(bot)`, which is called before the unload, and `async def import_state(bot, state)`,
+        which gets what `export_state` returned once the extension is loaded again (or, if the new version failed to
+        load, once the old one is back).
+        """
+        export_state = getattr(sys.modules.get(extension), "export_state", None)
+        state = await export_state(self) if export_state is not None else None
+        try:
+            self.reload_extensions(extension)
+        finally:
+            import_state = getattr(sys.modules.get(extension), "import_state", None)
+            if state is not None and import_state is not None:
+                await import_state(self, state)
 
     def load_tasks(self):
         tasks.load(self)
@@ -47,15 +148,68 @@ class Yuna(lightbulb.BotApp, ABC):
 
 intents = hikari.Intents.GUILD_MEMBERS | hikari.Intents.ALL_UNPRIVILEGED
 
+# What the "minimal" profile always runs with. Interactions need no intent, guild events keep the guild cache (and the
+# guild count) up to date and the bot's own user is needed by lightbulb.
+MINIMAL_INTENTS = hikari.Intents.GUILDS
+MINIMAL_CACHE = hikari.api.CacheComponents.GUILDS | hikari.api.CacheComponents.ME
+# Prefix commands are invoked by mentioning the bot, which only needs the message events and not their content.
+PREFIX_INTENTS = hikari.Intents.GUILD_MESSAGES | hikari.Intents.DM_MESSAGES
+
+
+def runtime_profile(profile: str, extensions: list):
+    """
+    Returns the gateway intents and cache components to run the extensions with. The "full" profile asks for
+    everything, "minimal" only for what the extensions need: plugins with prefix commands add the message intents and
+    anything else has to be opted into by the extension with module level `intents` and `cache_components`.
+    """
+    if profile == "full":
+        return intents, hikari.api.CacheComponents.ALL
+
+    needed_intents, cache_components = MINIMAL_INTENTS, MINIMAL_CACHE
+    for extension in extensions:
+        module = import_extension(extension)
+        needed_intents |= getattr(module, "intents", hikari.Intents.NONE)
+        cache_components |= getattr(module, "cache_components", hikari.api.CacheComponents.NONE)
+        plugin = getattr(module, "plugin", None)
+        if plugin is not None and any(lightbulb.PrefixCommand in getattr(command.callback, "__cmd_types__", ())
+                                      for command in plugin.raw_commands):
+            needed_intents |= PREFIX_INTENTS
+    return needed_intents, cache_components
+
+
+def main(shard_ids: list = None, shard_count: int = None, worker: int = None, status=None, stub: bool = False,
+         stub_crash_after: float = None):
+    """
+    Runs the bot. Supervisor.py runs one of these per worker process with the worker's `shard_ids` out of
+    `shard_count` shards, and a `status` pipe to report the worker's health on. `stub` runs the bot on the stub
+    gateway of StubGateway.py, which needs no token, so authentication.yaml is optional then.
+    """
+    path = os.path.join(ROOT, "authentication.yaml")
+    if stub and not os.path.exists(path):
+        yaml_data = {"Token": "stub"}
+    else:
+        with open(path, "r", encoding="utf8") as stream:
+            yaml_data = yaml.safe_load(stream)
+
+    Database.configure(yaml_data.get("Database"))
+    profile = yaml_data.get("Profile", "full")
+    extensions = Yuna.enabled_extensions(Yuna.extension_manifest(), yaml_data.get("Features"))
+    profile_intents, cache_components = runtime_profile(profile, extensions)
+    print(f"Running the {profile} profile with intents {profile_intents!r} and cache {cache_components!r}.")
 
-def main():
     instance = Yuna(
         token=yaml_data["Token"],
         help_class=None,
         prefix=lightbulb.when_mentioned_or(None),
-        intents=intents,
+        intents=profile_intents,
+        cache_settings=hikari.impl.CacheSettings(components=cache_components),
         default_enabled_guilds=test_guilds,
+        stub_gateway=stub,
+        stub_crash_after=stub_crash_after,
     )
+    instance.d.config = yaml_data
+    instance.d.profile = (profile, profile_intents, cache_components)
+    instance.d.worker = worker
     miru.load(instance)
 
     @instance.listen(lightbulb.LightbulbStartedEvent)
@@ -70,10 +224,23 @@ def main():
         )
         print(f"Currently in {await guilds.count()} guilds.")
 
+    @instance.listen(hikari.StoppedEvent)
+    async def on_stopped(event: hikari.StoppedEvent) -> None:
+        await Database.pool.close()
+
+    if status is not None:
+        from Supervisor import report_health
+
+        @instance.listen(hikari.StartedEvent)
+        async def on_started(event: hikari.StartedEvent) -> None:
+            instance.d.health_task = asyncio.create_task(report_health(instance, status, worker, shard_ids))
+
     instance.load_tasks()
     instance.load_configuration()
     instance.run(
-        asyncio_debug=True,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        asyncio_debug=yaml_data.get("AsyncioDebug", False),
         activity=hikari.Activity(
             name=f"Testing CI Pipeline...",
             type=hikari.ActivityType.WATCHING,
@@ -81,4 +248,5 @@ def main():
     )
 
 
-main()
+if __name__ == "__main__":
+    main()